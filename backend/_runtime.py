@@ -0,0 +1,525 @@
+'''
+Runtime shared by every backend function: JSON responses, request tracing,
+the connection pool, response compression, session tokens, conditional GETs
+and the per-user update sequence.
+
+This file is the single source. Functions are deployed one directory each,
+so scripts/sync_runtime.py copies it to backend/<name>/_runtime.py, where
+index.py imports it from; edit it here, rerun the script, and commit the
+copies with it. `scripts/sync_runtime.py --check` fails while any copy differs.
+psycopg2 is imported lazily inside the pool functions so OPTIONS preflights
+never load it.
+'''
+import functools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Callable, List, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+if orjson is not None:
+    def dumps(payload: Any) -> str:
+        return orjson.dumps(payload).decode()
+    loads = orjson.loads
+else:
+    dumps = json.dumps
+    loads = json.loads
+
+JSON_HEADERS = {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'}
+
+
+def respond(status: int, payload: Any, headers: Dict[str, str] = JSON_HEADERS) -> Dict[str, Any]:
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return {'statusCode': status, 'headers': headers, 'body': dumps(payload), 'isBase64Encoded': False}
+    started = time.perf_counter()
+    body = dumps(payload)
+    trace.serialize_ms += (time.perf_counter() - started) * 1000.0
+    return {'statusCode': status, 'headers': headers, 'body': body, 'isBase64Encoded': False}
+
+
+def error(status: int, message: str) -> Dict[str, Any]:
+    return respond(status, {'error': message})
+
+
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0.01'))
+FUNCTION_NAME = os.path.basename(os.path.dirname(os.path.abspath(__file__)))
+
+_local = threading.local()
+
+
+class RequestTrace:
+    '''Timings of one sampled request: connect, every query, JSON serialization, compression.'''
+    __slots__ = ('started', 'connect_ms', 'serialize_ms', 'compress_ms', 'queries')
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.connect_ms = 0.0
+        self.serialize_ms = 0.0
+        self.compress_ms = 0.0
+        self.queries: List[Tuple[str, float, int]] = []
+
+    def server_timing(self, total_ms: float) -> str:
+        db_ms = sum(q[1] for q in self.queries)
+        return (f'db;dur={db_ms:.2f};desc="{len(self.queries)} queries", '
+                f'connect;dur={self.connect_ms:.2f}, serialize;dur={self.serialize_ms:.2f}, '
+                f'compress;dur={self.compress_ms:.2f}, total;dur={total_ms:.2f}')
+
+    def log(self, route: str, status: int, total_ms: float) -> None:
+        print(dumps({
+            'function': FUNCTION_NAME,
+            'route': route,
+            'status': status,
+            'total_ms': round(total_ms, 3),
+            'connect_ms': round(self.connect_ms, 3),
+            'serialize_ms': round(self.serialize_ms, 3),
+            'compress_ms': round(self.compress_ms, 3),
+            'queries': [{'sql': sql, 'ms': round(ms, 3), 'rows': rows} for sql, ms, rows in self.queries]
+        }))
+
+
+class TracedCursor:
+    '''Cursor proxy that records normalized SQL, duration and row count of each execute.'''
+
+    def __init__(self, cur: Any, trace: RequestTrace) -> None:
+        self._cur = cur
+        self._trace = trace
+
+    def execute(self, query: str, params: Any = None) -> None:
+        started = time.perf_counter()
+        try:
+            self._cur.execute(query, params)
+        finally:
+            self._trace.queries.append((
+                ' '.join(query.split())[:200],
+                (time.perf_counter() - started) * 1000.0,
+                self._cur.rowcount
+            ))
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._cur, name)
+
+
+def start_trace() -> Optional[RequestTrace]:
+    if TRACE_SAMPLE_RATE <= 0:
+        return None
+    if TRACE_SAMPLE_RATE < 1:
+        import random
+        if random.random() >= TRACE_SAMPLE_RATE:
+            return None
+    return RequestTrace()
+
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '4'))
+DB_POOL_PING_AFTER = float(os.environ.get('DB_POOL_PING_AFTER', '30'))
+
+_pool: List[Tuple[Any, float]] = []
+_pool_lock = threading.Lock()
+
+
+def _discard_connection(conn: Any) -> None:
+    import psycopg2
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+
+def acquire_connection(db_url: str) -> Any:
+    '''
+    Takes a warm connection from the module-level pool or opens a new one.
+    Connections idle longer than DB_POOL_PING_AFTER seconds are pinged first,
+    broken ones are dropped and replaced by a fresh connect.
+    '''
+    import psycopg2
+    while True:
+        with _pool_lock:
+            if not _pool:
+                break
+            conn, released_at = _pool.pop()
+        if conn.closed:
+            continue
+        if time.monotonic() - released_at < DB_POOL_PING_AFTER:
+            return conn
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return conn
+        except psycopg2.Error:
+            _discard_connection(conn)
+    return psycopg2.connect(db_url)
+
+
+def release_connection(conn: Any) -> None:
+    '''
+    Rolls back any transaction left open by the request and puts the connection
+    back into the pool, closing it instead when the pool is full or DB_POOL_SIZE is 0.
+    '''
+    import psycopg2
+    import psycopg2.extensions
+    if conn.closed:
+        return
+    try:
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+    except psycopg2.Error:
+        _discard_connection(conn)
+        return
+    with _pool_lock:
+        if len(_pool) < DB_POOL_SIZE:
+            _pool.append((conn, time.monotonic()))
+            return
+    _discard_connection(conn)
+
+
+# Compression: bodies of at least COMPRESS_MIN_BYTES are brotli- or gzip-encoded
+# when Accept-Encoding allows it and returned base64-encoded, which the gateway
+# decodes before sending. brotli is optional; without it only gzip is offered.
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', '1024'))
+COMPRESS_GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', '6'))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', '4'))
+
+
+def choose_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    '''Returns the acceptable coding with the highest q-value (br on a tie), or None.'''
+    if not accept_encoding:
+        return None
+    weights: Dict[str, float] = {}
+    for entry in accept_encoding.lower().split(','):
+        coding, _, params = entry.partition(';')
+        params = params.strip()
+        try:
+            weights[coding.strip()] = float(params[2:]) if params.startswith('q=') else 1.0
+        except ValueError:
+            weights[coding.strip()] = 0.0
+    chosen, chosen_q = None, 0.0
+    for coding in ('br', 'gzip') if brotli is not None else ('gzip',):
+        q = weights.get(coding, weights.get('*', 0.0))
+        if q > chosen_q:
+            chosen, chosen_q = coding, q
+    return chosen
+
+
+def compress_response(response: Dict[str, Any], accept_encoding: Optional[str]) -> Dict[str, Any]:
+    '''
+    Encodes a large response body for the client. Every large body varies on
+    Accept-Encoding, and an encoded body's ETag is weakened since its bytes
+    differ from the identity representation.
+    '''
+    if response['isBase64Encoded']:
+        return response
+    data = response['body'].encode()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+    headers = dict(response['headers'])
+    vary = headers.get('Vary')
+    if vary is None:
+        headers['Vary'] = 'Accept-Encoding'
+    elif 'Accept-Encoding' not in vary:
+        headers['Vary'] = f'{vary}, Accept-Encoding'
+    encoding = choose_encoding(accept_encoding)
+    if encoding is None:
+        return {**response, 'headers': headers}
+
+    import base64
+    if encoding == 'br':
+        data = brotli.compress(data, mode=brotli.MODE_TEXT, quality=COMPRESS_BROTLI_QUALITY)
+    else:
+        import gzip
+        data = gzip.compress(data, COMPRESS_GZIP_LEVEL, mtime=0)
+    headers['Content-Encoding'] = encoding
+    if headers.get('ETag', 'W/').startswith('"'):
+        headers['ETag'] = 'W/' + headers['ETag']
+    return {**response, 'headers': headers, 'body': base64.b64encode(data).decode(), 'isBase64Encoded': True}
+
+
+def run_with_connection(action: Callable[..., Dict[str, Any]], *args: Any,
+                        accept_encoding: Optional[str] = None) -> Dict[str, Any]:
+    '''
+    Runs action(conn, cur, *args) on a pooled connection and compresses the
+    response for accept_encoding. Sampled requests (TRACE_SAMPLE_RATE) get a
+    Server-Timing header and one JSON log line.
+    '''
+    db_url = os.environ.get('DATABASE_URL')
+    if not db_url:
+        return error(500, 'Database not configured')
+    trace = start_trace()
+    if trace is None:
+        conn = acquire_connection(db_url)
+        cur = conn.cursor()
+        try:
+            response = action(conn, cur, *args)
+        finally:
+            cur.close()
+            release_connection(conn)
+        return compress_response(response, accept_encoding)
+
+    # Reset even when no connection could be acquired, or the next request
+    # on this thread would record into this trace
+    _local.trace = trace
+    try:
+        conn = acquire_connection(db_url)
+        trace.connect_ms = (time.perf_counter() - trace.started) * 1000.0
+        cur = conn.cursor()
+        try:
+            response = action(conn, TracedCursor(cur, trace), *args)
+        finally:
+            cur.close()
+            release_connection(conn)
+    finally:
+        _local.trace = None
+    started = time.perf_counter()
+    response = compress_response(response, accept_encoding)
+    trace.compress_ms = (time.perf_counter() - started) * 1000.0
+    total_ms = (time.perf_counter() - trace.started) * 1000.0
+    response['headers'] = {
+        **response['headers'],
+        'Server-Timing': trace.server_timing(total_ms),
+        'Timing-Allow-Origin': '*'
+    }
+    trace.log(action.__name__, response['statusCode'], total_ms)
+    return response
+
+
+# Sessions: auth (and users, on registration) issue
+# "<user_id>.<issued_at>.<expires_at>.<kid>.<signature>" tokens, signed with
+# HMAC-SHA256 under the first of SESSION_KEYS ("kid:secret,..."). Checking one
+# is pure CPU: no query, and verified tokens are cached so repeat requests
+# skip the HMAC too. Keep retired kids listed after the signing key for as
+# long as their tokens should stay valid; dropping a kid revokes every token
+# it signed. SESSION_REVOKED ("user_id[:issued_before],...") revokes a user's
+# tokens issued before the given unix time (all of them without one).
+# While no keys are configured the legacy X-User-Id header is still trusted.
+
+
+def parse_session_keys(value: str) -> Dict[str, bytes]:
+    keys = {}
+    for entry in value.split(','):
+        kid, _, secret = entry.strip().partition(':')
+        if kid and secret:
+            keys[kid] = secret.encode()
+    return keys
+
+
+def parse_revocations(value: str) -> Dict[str, float]:
+    revoked = {}
+    for entry in value.split(','):
+        user_id, _, before = entry.strip().partition(':')
+        if user_id:
+            revoked[user_id] = float(before) if before else float('inf')
+    return revoked
+
+
+SESSION_KEYS = parse_session_keys(os.environ.get('SESSION_KEYS', ''))
+SESSION_SIGNING_KID = next(iter(SESSION_KEYS), None)
+SESSION_REVOKED = parse_revocations(os.environ.get('SESSION_REVOKED', ''))
+SESSION_ALLOW_USER_ID_HEADER = os.environ.get('SESSION_ALLOW_USER_ID_HEADER', '0' if SESSION_KEYS else '1') == '1'
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '10000'))
+SESSION_TTL_SECONDS = int(os.environ.get('SESSION_TTL_SECONDS', str(30 * 24 * 3600)))
+
+_session_cache: 'OrderedDict[str, Tuple[str, int, int]]' = OrderedDict()
+_session_lock = threading.Lock()
+
+
+def sign(payload: str) -> str:
+    '''Appends the signature under the signing key; callers check SESSION_SIGNING_KID first.'''
+    import base64
+    import hmac
+
+    digest = hmac.digest(SESSION_KEYS[SESSION_SIGNING_KID], payload.encode(), 'sha256')
+    return f'{payload}.{base64.urlsafe_b64encode(digest).rstrip(b"=").decode()}'
+
+
+def signature_valid(token: str, kid: str, signature: str) -> bool:
+    import base64
+    import hmac
+
+    key = SESSION_KEYS.get(kid)
+    if key is None:
+        return False
+    digest = hmac.digest(key, token[:-len(signature) - 1].encode(), 'sha256')
+    return hmac.compare_digest(base64.urlsafe_b64encode(digest).rstrip(b'='), signature.encode())
+
+
+def issue_session_token(user_id: int) -> Optional[str]:
+    '''Signs a session token for user_id; None while no SESSION_KEYS are configured.'''
+    if SESSION_SIGNING_KID is None:
+        return None
+    issued_at = int(time.time())
+    return sign(f'{user_id}.{issued_at}.{issued_at + SESSION_TTL_SECONDS}.{SESSION_SIGNING_KID}')
+
+
+def verify_session_token(token: str) -> Optional[str]:
+    '''Returns the user id a valid, unexpired and unrevoked token was issued to, else None.'''
+    with _session_lock:
+        claims = _session_cache.get(token)
+        if claims is not None:
+            _session_cache.move_to_end(token)
+
+    if claims is None:
+        parts = token.split('.')
+        if len(parts) != 5:
+            return None
+        user_id, issued_at, expires_at, kid, signature = parts
+        if not user_id.isdigit() or not issued_at.isdigit() or not expires_at.isdigit():
+            return None
+        if not signature_valid(token, kid, signature):
+            return None
+        claims = (user_id, int(issued_at), int(expires_at))
+        if SESSION_CACHE_SIZE > 0:
+            with _session_lock:
+                _session_cache[token] = claims
+                while len(_session_cache) > SESSION_CACHE_SIZE:
+                    _session_cache.popitem(last=False)
+
+    user_id, issued_at, expires_at = claims
+    if expires_at <= time.time() or issued_at < SESSION_REVOKED.get(user_id, 0):
+        return None
+    return user_id
+
+
+def authenticate(headers: Dict[str, str]) -> Tuple[Optional[str], bool]:
+    '''
+    Resolves the caller from "Authorization: Bearer <token>" (or X-Auth-Token).
+    Returns (user_id, token_presented); user_id is None when unauthenticated.
+    '''
+    authorization = headers.get('authorization') or headers.get('Authorization') or ''
+    token = authorization[7:].strip() if authorization[:7].lower() == 'bearer ' else (
+        headers.get('x-auth-token') or headers.get('X-Auth-Token'))
+    if token:
+        return verify_session_token(token), True
+    if SESSION_ALLOW_USER_ID_HEADER:
+        return headers.get('x-user-id') or headers.get('X-User-Id'), False
+    return None, False
+
+
+# Registration tickets: "reg.<phone>.<expires_at>.<kid>.<signature>" (phone
+# base64url-encoded), signed like session tokens. auth's verify_code hands one
+# out for a verified phone without an account, and POST /users requires it
+# once SESSION_KEYS are set, so only the owner of the number can register it.
+REGISTRATION_TICKET_TTL_SECONDS = int(os.environ.get('REGISTRATION_TICKET_TTL_SECONDS', '900'))
+
+
+def normalize_phone(phone: Any) -> Optional[str]:
+    '''
+    The canonical form phones are stored, rate-limited and ticketed under
+    (V0012): digits only, with a domestic 8XXXXXXXXXX written as 7XXXXXXXXXX.
+    None unless that leaves 10 to 15 digits.
+    '''
+    if not isinstance(phone, str):
+        return None
+    digits = ''.join(c for c in phone if c.isdigit() and c.isascii())
+    if len(digits) == 11 and digits[0] == '8':
+        digits = '7' + digits[1:]
+    return digits if 10 <= len(digits) <= 15 else None
+
+
+def issue_registration_ticket(phone: str) -> Optional[str]:
+    '''Signs a short-lived ticket bound to phone; None while no SESSION_KEYS are configured.'''
+    if SESSION_SIGNING_KID is None:
+        return None
+    import base64
+
+    encoded_phone = base64.urlsafe_b64encode(phone.encode()).rstrip(b'=').decode()
+    return sign(f'reg.{encoded_phone}.{int(time.time()) + REGISTRATION_TICKET_TTL_SECONDS}.{SESSION_SIGNING_KID}')
+
+
+def verify_registration_ticket(ticket: str) -> Optional[str]:
+    '''Returns the phone a valid, unexpired registration ticket was issued for, else None.'''
+    import base64
+    import binascii
+
+    parts = ticket.split('.')
+    if len(parts) != 5 or parts[0] != 'reg':
+        return None
+    _, encoded_phone, expires_at, kid, signature = parts
+    if not expires_at.isdigit() or int(expires_at) <= time.time() or not signature_valid(ticket, kid, signature):
+        return None
+    try:
+        return base64.urlsafe_b64decode(encoded_phone + '=' * (-len(encoded_phone) % 4)).decode()
+    except (binascii.Error, UnicodeDecodeError):
+        return None
+
+
+# Conditional GET: views wrapped with @conditional(etag_of) get an ETag computed
+# by a cheap query (or none), and a matching If-None-Match is answered with
+# 304 Not Modified before the view's own query runs.
+CONDITIONAL_HEADERS = {
+    'Cache-Control': 'private, no-cache',
+    'Vary': 'Authorization, X-Auth-Token, X-User-Id, Accept-Encoding',
+    'Access-Control-Expose-Headers': 'ETag'
+}
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return any(tag.strip().removeprefix('W/') == etag for tag in if_none_match.split(','))
+
+
+def conditional(etag_of: Callable[[Any, str, Dict[str, str]], Optional[str]]) -> Callable[..., Any]:
+    '''
+    Decorates a GET view(conn, cur, user_id, query_params); the wrapped view
+    takes the request's If-None-Match as an extra argument. etag_of returns
+    None when the request has no stable validator (e.g. invalid parameters).
+    '''
+    def decorate(view: Callable[..., Dict[str, Any]]) -> Callable[..., Dict[str, Any]]:
+        @functools.wraps(view)
+        def wrapper(conn: Any, cur: Any, user_id: str, query_params: Dict[str, str],
+                    if_none_match: Optional[str] = None) -> Dict[str, Any]:
+            etag = etag_of(cur, user_id, query_params)
+            if etag is None:
+                return view(conn, cur, user_id, query_params)
+            if etag_matches(if_none_match, etag):
+                return {
+                    'statusCode': 304,
+                    'headers': {'Access-Control-Allow-Origin': '*', **CONDITIONAL_HEADERS, 'ETag': etag},
+                    'body': '',
+                    'isBase64Encoded': False
+                }
+            response = view(conn, cur, user_id, query_params)
+            if response['statusCode'] == 200:
+                response['headers'] = {**response['headers'], **CONDITIONAL_HEADERS, 'ETag': etag}
+            return response
+        wrapper.conditional = True
+        return wrapper
+    return decorate
+
+
+# Per-user update sequence (V0010). A statement that defines a CTE
+# updates(user_id, kind, chat_id, message_id, message_at, peer_id) appends
+# these CTEs: recipients are locked in id order, so overlapping appends queue
+# instead of deadlocking, each one's users.pts moves on by its number of
+# updates, and the rows are stored under the pts values in between. The
+# recipient's new pts is in bumped.
+APPEND_UPDATES_CTES = """
+    , recipients AS (
+        SELECT id FROM users WHERE id IN (SELECT user_id FROM updates) ORDER BY id FOR UPDATE
+    ), bumped AS (
+        UPDATE users u
+        SET pts = u.pts + n.count
+        FROM (SELECT user_id, COUNT(*) AS count FROM updates GROUP BY user_id) n
+        WHERE u.id = n.user_id AND u.id IN (SELECT id FROM recipients)
+        RETURNING u.id, u.pts - n.count AS base, u.pts
+    ), appended AS (
+        INSERT INTO user_updates (user_id, pts, kind, chat_id, message_id, message_at, peer_id)
+        SELECT up.user_id, b.base + ROW_NUMBER() OVER (PARTITION BY up.user_id ORDER BY up.message_id, up.chat_id),
+               up.kind, up.chat_id, up.message_id, up.message_at, up.peer_id
+        FROM updates up
+        JOIN bumped b ON b.id = up.user_id
+    )
+"""
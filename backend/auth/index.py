@@ -1,9 +1,235 @@
-import json
 import os
-import random
-import psycopg2
-from datetime import datetime, timedelta
-from typing import Dict, Any
+from typing import Dict, Any, Callable, List, Optional, Tuple
+
+from _runtime import (
+    SESSION_KEYS, error, issue_registration_ticket, issue_session_token, loads, normalize_phone, respond,
+    run_with_connection
+)
+
+PREFLIGHT_RESPONSE = {
+    'statusCode': 200,
+    'headers': {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'POST, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type',
+        'Access-Control-Max-Age': '86400'
+    },
+    'body': '',
+    'isBase64Encoded': False
+}
+
+
+SMS_CODE_TTL_MINUTES = 5
+SMS_PHONE_BUCKET = (float(os.environ.get('SMS_PHONE_BURST', '3')), float(os.environ.get('SMS_PHONE_PER_MINUTE', '1')))
+# Verification attempts per phone: with the defaults a 6-digit code can't be guessed before it expires
+SMS_VERIFY_BUCKET = (float(os.environ.get('SMS_VERIFY_BURST', '5')), float(os.environ.get('SMS_VERIFY_PER_MINUTE', '1')))
+SMS_IP_BUCKET = (float(os.environ.get('SMS_IP_BURST', '20')), float(os.environ.get('SMS_IP_PER_MINUTE', '10')))
+# Proxies in front of the function that append to X-Forwarded-For; only used without a gateway sourceIp
+SMS_TRUSTED_PROXY_HOPS = int(os.environ.get('SMS_TRUSTED_PROXY_HOPS', '0'))
+# Echoing the code back is for local development only, and never once sessions are signed
+SMS_RETURN_DEV_CODE = os.environ.get('SMS_RETURN_DEV_CODE', '0') == '1' and not SESSION_KEYS
+SMS_SWEEP_PROBABILITY = float(os.environ.get('SMS_SWEEP_PROBABILITY', '0.05'))
+SMS_SWEEP_BATCH = int(os.environ.get('SMS_SWEEP_BATCH', '1000'))
+SMS_SWEEP_MAX_BATCHES = 10
+
+# Token buckets: each bucket named in %(buckets)s is refilled for the time
+# since its last use and spends a token if it has one; allowed says whether it did.
+SPEND_TOKENS_CTE = """
+    limits AS (
+        INSERT INTO rate_limits AS r (bucket, capacity, refill_per_sec, tokens, allowed, updated_at)
+        SELECT b.bucket, b.capacity, b.refill_per_sec, b.capacity - 1, TRUE, NOW()
+        FROM unnest(%(buckets)s::text[], %(capacities)s::real[], %(refills)s::real[])
+            AS b(bucket, capacity, refill_per_sec)
+        ON CONFLICT (bucket) DO UPDATE SET
+            tokens = CASE
+                WHEN LEAST(EXCLUDED.capacity, r.tokens + EXTRACT(EPOCH FROM NOW() - r.updated_at) * EXCLUDED.refill_per_sec) >= 1
+                THEN LEAST(EXCLUDED.capacity, r.tokens + EXTRACT(EPOCH FROM NOW() - r.updated_at) * EXCLUDED.refill_per_sec) - 1
+                ELSE LEAST(EXCLUDED.capacity, r.tokens + EXTRACT(EPOCH FROM NOW() - r.updated_at) * EXCLUDED.refill_per_sec)
+            END,
+            allowed = LEAST(EXCLUDED.capacity, r.tokens + EXTRACT(EPOCH FROM NOW() - r.updated_at) * EXCLUDED.refill_per_sec) >= 1,
+            capacity = EXCLUDED.capacity,
+            refill_per_sec = EXCLUDED.refill_per_sec,
+            updated_at = NOW()
+        RETURNING allowed, tokens, refill_per_sec
+    )
+"""
+RETRY_AFTER_SQL = "(SELECT COALESCE(MAX(CEIL((1 - tokens) / refill_per_sec)) FILTER (WHERE NOT allowed), 0) FROM limits)"
+
+# The buckets and the code insert in one statement: the code is only stored
+# when every bucket allowed the request.
+SEND_CODE_SQL = "WITH " + SPEND_TOKENS_CTE + """, code AS (
+        INSERT INTO sms_codes (phone, code, expires_at)
+        SELECT %(phone)s, %(code)s, NOW() + %(ttl_minutes)s * INTERVAL '1 minute'
+        WHERE NOT EXISTS (SELECT 1 FROM limits WHERE NOT allowed)
+        RETURNING id
+    )
+    SELECT EXISTS (SELECT 1 FROM code), """ + RETRY_AFTER_SQL
+
+# Every attempt spends a token of the phone's verify bucket first. Within
+# budget, the newest matching pending code is consumed (idx_sms_codes_pending)
+# and the user looked up in the same statement; concurrent verifies cannot
+# both succeed.
+VERIFY_CODE_SQL = "WITH " + SPEND_TOKENS_CTE + """, used AS (
+        UPDATE sms_codes SET verified = TRUE
+        WHERE NOT EXISTS (SELECT 1 FROM limits WHERE NOT allowed) AND id = (
+            SELECT id FROM sms_codes
+            WHERE phone = %(phone)s AND code = %(code)s AND verified = FALSE AND expires_at > NOW()
+            ORDER BY expires_at DESC
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id
+    )
+    SELECT NOT EXISTS (SELECT 1 FROM limits WHERE NOT allowed), """ + RETRY_AFTER_SQL + """,
+           EXISTS (SELECT 1 FROM used), u.id, u.nickname, u.username
+    FROM (SELECT 1) one
+    LEFT JOIN users u ON u.phone = %(phone)s
+"""
+
+
+def bucket_params(buckets: List[Tuple[str, float, float]]) -> Dict[str, Any]:
+    '''SQL parameters for SPEND_TOKENS_CTE from (name, burst, per_minute) buckets.'''
+    return {
+        'buckets': [b[0] for b in buckets],
+        'capacities': [b[1] for b in buckets],
+        'refills': [b[2] / 60.0 for b in buckets]
+    }
+
+
+def too_many(message: str, retry_after: float) -> Dict[str, Any]:
+    response = error(429, message)
+    response['headers'] = {**response['headers'], 'Retry-After': str(int(retry_after))}
+    return response
+
+
+def client_ip(event: Dict[str, Any]) -> Optional[str]:
+    '''
+    The address the per-IP bucket is keyed on: the gateway's sourceIp, else
+    the X-Forwarded-For hop appended by the outermost of SMS_TRUSTED_PROXY_HOPS
+    trusted proxies. Entries before it are client-supplied and never used;
+    None (no IP bucket) when neither is available.
+    '''
+    identity = (event.get('requestContext') or {}).get('identity') or {}
+    if identity.get('sourceIp'):
+        return identity['sourceIp']
+    if SMS_TRUSTED_PROXY_HOPS <= 0:
+        return None
+    headers = event.get('headers') or {}
+    forwarded = [hop.strip() for hop in (headers.get('X-Forwarded-For') or headers.get('x-forwarded-for') or '').split(',')]
+    if len(forwarded) < SMS_TRUSTED_PROXY_HOPS or not forwarded[-SMS_TRUSTED_PROXY_HOPS]:
+        return None
+    return forwarded[-SMS_TRUSTED_PROXY_HOPS]
+
+
+def sweep_sms_codes(conn: Any, cur: Any) -> int:
+    '''
+    Deletes expired or already verified codes, and rate-limit buckets that
+    have refilled completely, SMS_SWEEP_BATCH rows per committed batch.
+    Concurrent sweepers skip each other's rows. Returns the number of codes removed.
+    '''
+    removed = 0
+    for _ in range(SMS_SWEEP_MAX_BATCHES):
+        cur.execute("""
+            DELETE FROM sms_codes WHERE id IN (
+                SELECT id FROM sms_codes
+                WHERE verified OR expires_at < NOW()
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+        """, (SMS_SWEEP_BATCH,))
+        conn.commit()
+        removed += cur.rowcount
+        if cur.rowcount < SMS_SWEEP_BATCH:
+            break
+    cur.execute("""
+        DELETE FROM rate_limits WHERE bucket IN (
+            SELECT bucket FROM rate_limits
+            WHERE tokens + EXTRACT(EPOCH FROM NOW() - updated_at) * refill_per_sec >= capacity
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+    """, (SMS_SWEEP_BATCH,))
+    conn.commit()
+    return removed
+
+
+def send_code(conn: Any, cur: Any, body_data: Dict[str, Any], ip: Optional[str]) -> Dict[str, Any]:
+    import random
+    phone = normalize_phone(body_data.get('phone'))
+    if not phone:
+        return error(400, 'A valid phone number is required')
+
+    buckets = [(f'sms:phone:{phone}',) + SMS_PHONE_BUCKET]
+    if ip:
+        buckets.append((f'sms:ip:{ip}',) + SMS_IP_BUCKET)
+    code = str(random.randint(100000, 999999))
+
+    cur.execute(SEND_CODE_SQL, {
+        **bucket_params(buckets),
+        'phone': phone,
+        'code': code,
+        'ttl_minutes': SMS_CODE_TTL_MINUTES
+    })
+    stored, retry_after = cur.fetchone()
+    conn.commit()
+
+    if not stored:
+        return too_many('Too many code requests, try again later', retry_after)
+
+    print(f"SMS Code for {phone}: {code}")
+
+    if SMS_SWEEP_PROBABILITY > 0 and random.random() < SMS_SWEEP_PROBABILITY:
+        sweep_sms_codes(conn, cur)
+
+    payload = {'success': True, 'message': 'Code sent successfully'}
+    if SMS_RETURN_DEV_CODE:
+        payload['dev_code'] = code
+    return respond(200, payload)
+
+
+def verify_code(conn: Any, cur: Any, body_data: Dict[str, Any], ip: Optional[str]) -> Dict[str, Any]:
+    phone = normalize_phone(body_data.get('phone'))
+    code = body_data.get('code')
+
+    if not phone or not code:
+        return error(400, 'Phone and code are required')
+
+    cur.execute(VERIFY_CODE_SQL, {
+        **bucket_params([(f'sms:verify:{phone}',) + SMS_VERIFY_BUCKET]),
+        'phone': phone,
+        'code': code
+    })
+    allowed, retry_after, verified, user_id, nickname, username = cur.fetchone()
+    conn.commit()
+
+    if not allowed:
+        return too_many('Too many attempts, try again later', retry_after)
+    if not verified:
+        return error(400, 'Invalid or expired code')
+
+    if user_id:
+        return respond(200, {
+            'success': True,
+            'user_exists': True,
+            'user': {
+                'id': user_id,
+                'nickname': nickname,
+                'username': username
+            },
+            'token': issue_session_token(user_id)
+        })
+    return respond(200, {
+        'success': True,
+        'user_exists': False,
+        'registration_ticket': issue_registration_ticket(phone)
+    })
+
+
+POST_ACTIONS: Dict[str, Callable[..., Dict[str, Any]]] = {
+    'send_code': send_code,
+    'verify_code': verify_code,
+}
+
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
@@ -12,143 +238,16 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     Returns: HTTP response with success/error status
     '''
     method: str = event.get('httpMethod', 'GET')
-    
+
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
-    
+        return PREFLIGHT_RESPONSE
+
     if method != 'POST':
-        return {
-            'statusCode': 405,
-            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
-    
-    body_data = json.loads(event.get('body', '{}'))
-    action = body_data.get('action')
-    
-    db_url = os.environ.get('DATABASE_URL')
-    if not db_url:
-        return {
-            'statusCode': 500,
-            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'Database not configured'}),
-            'isBase64Encoded': False
-        }
-    
-    conn = psycopg2.connect(db_url)
-    cur = conn.cursor()
-    
-    try:
-        if action == 'send_code':
-            phone = body_data.get('phone')
-            if not phone:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                    'body': json.dumps({'error': 'Phone is required'}),
-                    'isBase64Encoded': False
-                }
-            
-            code = str(random.randint(100000, 999999))
-            expires_at = datetime.now() + timedelta(minutes=5)
-            
-            cur.execute(
-                "INSERT INTO sms_codes (phone, code, expires_at) VALUES (%s, %s, %s)",
-                (phone, code, expires_at)
-            )
-            conn.commit()
-            
-            print(f"SMS Code for {phone}: {code}")
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                'body': json.dumps({
-                    'success': True,
-                    'message': 'Code sent successfully',
-                    'dev_code': code
-                }),
-                'isBase64Encoded': False
-            }
-        
-        elif action == 'verify_code':
-            phone = body_data.get('phone')
-            code = body_data.get('code')
-            
-            if not phone or not code:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                    'body': json.dumps({'error': 'Phone and code are required'}),
-                    'isBase64Encoded': False
-                }
-            
-            cur.execute(
-                "SELECT id FROM sms_codes WHERE phone = %s AND code = %s AND verified = FALSE AND expires_at > NOW() ORDER BY created_at DESC LIMIT 1",
-                (phone, code)
-            )
-            result = cur.fetchone()
-            
-            if not result:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                    'body': json.dumps({'error': 'Invalid or expired code'}),
-                    'isBase64Encoded': False
-                }
-            
-            cur.execute("UPDATE sms_codes SET verified = TRUE WHERE id = %s", (result[0],))
-            
-            cur.execute("SELECT id, nickname, username FROM users WHERE phone = %s", (phone,))
-            user = cur.fetchone()
-            
-            conn.commit()
-            
-            if user:
-                return {
-                    'statusCode': 200,
-                    'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                    'body': json.dumps({
-                        'success': True,
-                        'user_exists': True,
-                        'user': {
-                            'id': user[0],
-                            'nickname': user[1],
-                            'username': user[2]
-                        }
-                    }),
-                    'isBase64Encoded': False
-                }
-            else:
-                return {
-                    'statusCode': 200,
-                    'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                    'body': json.dumps({
-                        'success': True,
-                        'user_exists': False
-                    }),
-                    'isBase64Encoded': False
-                }
-        
-        else:
-            return {
-                'statusCode': 400,
-                'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                'body': json.dumps({'error': 'Invalid action'}),
-                'isBase64Encoded': False
-            }
-    
-    finally:
-        cur.close()
-        conn.close()
+        return error(405, 'Method not allowed')
+
+    body_data = loads(event.get('body') or '{}')
+    action = POST_ACTIONS.get(body_data.get('action'))
+    if action is None:
+        return error(400, 'Invalid action')
+
+    return run_with_connection(action, body_data, client_ip(event))
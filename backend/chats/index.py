@@ -1,173 +1,1061 @@
-import json
 import os
-import psycopg2
-from typing import Dict, Any
+import select
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Callable, List, Optional, Tuple
 
-def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+from _runtime import (
+    APPEND_UPDATES_CTES, SESSION_ALLOW_USER_ID_HEADER, authenticate, conditional, dumps, error, loads,
+    respond, run_with_connection
+)
+
+PREFLIGHT_RESPONSE = {
+    'statusCode': 200,
+    'headers': {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type, Authorization, X-Auth-Token, X-User-Id, If-None-Match',
+        'Access-Control-Max-Age': '86400'
+    },
+    'body': '',
+    'isBase64Encoded': False
+}
+
+
+MEMBERSHIP_CACHE_SIZE = int(os.environ.get('MEMBERSHIP_CACHE_SIZE', '10000'))
+MEMBERSHIP_CACHE_TTL = float(os.environ.get('MEMBERSHIP_CACHE_TTL', '60'))
+# 'cache': skip the membership probe for cached pairs; 'inline': always probe inside the INSERT
+SEND_MEMBERSHIP_CHECK = os.environ.get('SEND_MEMBERSHIP_CHECK', 'cache')
+
+
+class MembershipCache:
     '''
-    Business: Manages chats - create private/group chats, get chat list, send messages
-    Args: event with httpMethod, headers with X-User-Id, body with chat data
-    Returns: HTTP response with chat data
+    Bounded LRU of (chat_id, user_id) pairs known to be members, each trusted
+    for MEMBERSHIP_CACHE_TTL seconds. Only positive answers are cached, and a
+    chat's entries are dropped whenever this process changes its members;
+    removals made by other instances become visible once the TTL runs out.
     '''
-    method: str = event.get('httpMethod', 'GET')
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self._entries: 'OrderedDict[Tuple[int, int], float]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_size = max_size
+        self.ttl = ttl
+
+    def contains(self, chat_id: int, user_id: int) -> bool:
+        key = (chat_id, user_id)
+        with self._lock:
+            expires_at = self._entries.get(key)
+            if expires_at is None:
+                return False
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return False
+            self._entries.move_to_end(key)
+            return True
+
+    def add(self, chat_id: int, user_id: int) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[(chat_id, user_id)] = time.monotonic() + self.ttl
+            self._entries.move_to_end((chat_id, user_id))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate_chat(self, chat_id: int) -> None:
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == chat_id]:
+                del self._entries[key]
+
+
+membership_cache = MembershipCache(MEMBERSHIP_CACHE_SIZE, MEMBERSHIP_CACHE_TTL)
+
+
+def is_member(cur: Any, chat_id: int, user_id: str) -> bool:
+    if membership_cache.contains(chat_id, int(user_id)):
+        return True
+    cur.execute("SELECT 1 FROM chat_members WHERE chat_id = %s AND user_id = %s", (chat_id, user_id))
+    if not cur.fetchone():
+        return False
+    membership_cache.add(chat_id, int(user_id))
+    return True
+
+
+# One round trip per send: the INSERT, denormalized chat/read-state updates,
+# the members' new_message updates and the long-poll notification run as a
+# single statement. The members are only locked once the chat row is, so
+# concurrent sends to one chat still queue on the chat row first. The _IF_MEMBER form
+# inserts nothing (and returns no row) when the sender is not in the chat.
+_SEND_MESSAGE_TEMPLATE = """
+    WITH msg AS (
+        INSERT INTO messages (chat_id, user_id, text)
+        SELECT %(chat_id)s, %(user_id)s, %(text)s
+        {membership_guard}
+        RETURNING id, created_at
+    ), chat AS (
+        UPDATE chats c
+        SET last_message_id = msg.id,
+            last_message_preview = LEFT(%(text)s, %(preview_length)s),
+            last_message_at = msg.created_at,
+            updated_at = msg.created_at
+        FROM msg
+        WHERE c.id = %(chat_id)s
+        RETURNING c.id
+    ), sender AS (
+        UPDATE chat_members cm
+        SET last_read_message_id = msg.id
+        FROM msg
+        WHERE cm.chat_id = %(chat_id)s AND cm.user_id = %(user_id)s
+    ), notified AS (
+        SELECT pg_notify(%(channel)s, msg.id::text) FROM msg
+    ), updates AS (
+        SELECT cm.user_id, 'new_message' AS kind, chat.id AS chat_id, msg.id AS message_id,
+               msg.created_at AS message_at, NULL::int AS peer_id
+        FROM chat
+        JOIN chat_members cm ON cm.chat_id = chat.id
+        CROSS JOIN msg
+    ){append_updates}
+    SELECT msg.id, msg.created_at, (SELECT pts FROM bumped WHERE id = %(user_id)s)
+    FROM msg CROSS JOIN notified
+"""
+SEND_MESSAGE_SQL = _SEND_MESSAGE_TEMPLATE.format(membership_guard='', append_updates=APPEND_UPDATES_CTES)
+SEND_MESSAGE_IF_MEMBER_SQL = _SEND_MESSAGE_TEMPLATE.format(append_updates=APPEND_UPDATES_CTES, membership_guard=(
+    'WHERE EXISTS (SELECT 1 FROM chat_members WHERE chat_id = %(chat_id)s AND user_id = %(user_id)s)'
+))
+
+
+MEMBER_BATCH_SIZE = 1000
+
+
+def change_members(cur: Any, chat_id: Any, member_ids: List[int], add: bool) -> Tuple[int, int]:
+    '''
+    Adds or removes members MEMBER_BATCH_SIZE ids per statement, keeping
+    chats.member_count in step within the same statement. The chat row is
+    locked first, in the same order as send_message (chat, then membership),
+    so removing a member who is sending queues instead of deadlocking.
+    Returns (rows changed, resulting member_count).
+    '''
+    cur.execute("SELECT 1 FROM chats WHERE id = %s FOR UPDATE", (chat_id,))
+    if add:
+        statement = """
+            WITH changed AS (
+                INSERT INTO chat_members (chat_id, user_id)
+                SELECT %s, unnest(%s::int[])
+                ON CONFLICT DO NOTHING
+                RETURNING 1
+            )
+            UPDATE chats SET member_count = member_count + (SELECT COUNT(*) FROM changed)
+            WHERE id = %s
+            RETURNING (SELECT COUNT(*) FROM changed), member_count
+        """
+    else:
+        statement = """
+            WITH changed AS (
+                DELETE FROM chat_members
+                WHERE chat_id = %s AND user_id = ANY(%s::int[])
+                RETURNING 1
+            )
+            UPDATE chats SET member_count = member_count - (SELECT COUNT(*) FROM changed)
+            WHERE id = %s
+            RETURNING (SELECT COUNT(*) FROM changed), member_count
+        """
+    total_changed, member_count = 0, 0
+    for start in range(0, len(member_ids), MEMBER_BATCH_SIZE):
+        cur.execute(statement, (chat_id, member_ids[start:start + MEMBER_BATCH_SIZE], chat_id))
+        changed, member_count = cur.fetchone()
+        total_changed += changed
+    return total_changed, member_count
+
+
+SEND_BATCH_MAX = 1000
+
+
+def send_messages_batch(cur: Any, user_id: Any, items: List[Any]) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+    '''
+    Inserts a batch of {chat_id, text} items for one sender with one membership
+    query for all chats involved and one multi-row INSERT, keeping the chats'
+    last message, the sender's read position and the members' updates in step
+    like send_message. Returns (one result per item in input order: the stored
+    message or an error, the sender's new pts or None when nothing was sent).
+    '''
+    results: List[Dict[str, Any]] = [{} for _ in items]
+    valid: List[Tuple[int, int, str]] = []
+    for index, item in enumerate(items):
+        try:
+            chat_id = int(item['chat_id'])
+            text = item['text']
+        except (KeyError, TypeError, ValueError):
+            results[index] = {'error': 'chat_id and text are required'}
+            continue
+        if not isinstance(text, str) or not text:
+            results[index] = {'error': 'chat_id and text are required'}
+            continue
+        valid.append((index, chat_id, text))
     
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+    chat_ids = {chat_id for _, chat_id, _ in valid}
+    member_of = {chat_id for chat_id in chat_ids if membership_cache.contains(chat_id, int(user_id))}
+    unknown = sorted(chat_ids - member_of)
+    if unknown:
+        cur.execute(
+            "SELECT chat_id FROM chat_members WHERE user_id = %s AND chat_id = ANY(%s::int[])",
+            (user_id, unknown)
+        )
+        for row in cur.fetchall():
+            member_of.add(row[0])
+            membership_cache.add(row[0], int(user_id))
     
-    headers = event.get('headers', {})
-    user_id = headers.get('x-user-id') or headers.get('X-User-Id')
+    accepted = []
+    for index, chat_id, text in valid:
+        if chat_id in member_of:
+            accepted.append((index, chat_id, text))
+        else:
+            results[index] = {'error': 'Not a member of this chat'}
+    if not accepted:
+        return results, None
     
-    if not user_id:
-        return {
-            'statusCode': 401,
-            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'User ID required'}),
-            'isBase64Encoded': False
+    cur.execute("""
+        WITH msg AS (
+            INSERT INTO messages (chat_id, user_id, text)
+            SELECT chat_id, %s, text
+            FROM unnest(%s::int[], %s::text[]) WITH ORDINALITY AS t(chat_id, text, ord)
+            ORDER BY ord
+            RETURNING id, chat_id, text, created_at
+        ), last AS (
+            SELECT DISTINCT ON (chat_id) chat_id, id, text, created_at
+            FROM msg
+            ORDER BY chat_id, id DESC
+        ), chat AS (
+            UPDATE chats c
+            SET last_message_id = last.id,
+                last_message_preview = LEFT(last.text, %s),
+                last_message_at = last.created_at,
+                updated_at = last.created_at
+            FROM last
+            WHERE c.id = last.chat_id
+            RETURNING c.id
+        ), sender AS (
+            UPDATE chat_members cm
+            SET last_read_message_id = last.id
+            FROM last
+            WHERE cm.chat_id = last.chat_id AND cm.user_id = %s
+        ), updates AS (
+            SELECT cm.user_id, 'new_message' AS kind, msg.chat_id, msg.id AS message_id,
+                   msg.created_at AS message_at, NULL::int AS peer_id
+            FROM chat
+            JOIN chat_members cm ON cm.chat_id = chat.id
+            JOIN msg ON msg.chat_id = chat.id
+        )""" + APPEND_UPDATES_CTES + """
+        SELECT id, created_at, (SELECT pts FROM bumped WHERE id = %s) FROM msg ORDER BY id
+    """, (user_id, [a[1] for a in accepted], [a[2] for a in accepted], PREVIEW_LENGTH, user_id, user_id))
+    rows = cur.fetchall()
+    # ids come from one sequence in ORDER BY ord order, so sorting by id restores input order
+    for (index, chat_id, text), (message_id, created_at, _) in zip(accepted, rows):
+        results[index] = {
+            'id': message_id,
+            'chat_id': chat_id,
+            'user_id': int(user_id),
+            'text': text,
+            'created_at': created_at.isoformat()
         }
     
-    db_url = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(db_url)
-    cur = conn.cursor()
-    
+    last_ids: Dict[int, int] = {}
+    for result in results:
+        if 'id' in result:
+            last_ids[result['chat_id']] = result['id']
+    cur.execute(
+        "SELECT pg_notify('chat_' || chat_id, message_id::text) FROM unnest(%s::int[], %s::int[]) AS t(chat_id, message_id)",
+        (list(last_ids.keys()), list(last_ids.values()))
+    )
+    return results, rows[0][2]
+
+
+PREVIEW_LENGTH = 200
+UNREAD_COUNT_CAP = 1000
+
+SYNC_MAX_WAIT = float(os.environ.get('SYNC_MAX_WAIT', '25'))
+SYNC_BATCH_LIMIT = 500
+
+
+DIFFERENCE_DEFAULT_LIMIT = 100
+DIFFERENCE_MAX_LIMIT = 1000
+UPDATES_RETENTION_DAYS = int(os.environ.get('UPDATES_RETENTION_DAYS', '30'))
+UPDATES_SWEEP_PROBABILITY = float(os.environ.get('UPDATES_SWEEP_PROBABILITY', '0.01'))
+UPDATES_SWEEP_BATCH = int(os.environ.get('UPDATES_SWEEP_BATCH', '5000'))
+UPDATES_SWEEP_MAX_BATCHES = 10
+
+# The caller's current pts and the next page of updates after a device's pts,
+# with whatever each update points at: the message (pruned to one partition by
+# its created_at), the new chat, or the other user of a friendship change.
+DIFFERENCE_SQL = """
+    SELECT s.pts, uu.pts, uu.kind, uu.chat_id, uu.created_at,
+           m.id, m.user_id, mu.nickname, m.text, m.created_at,
+           c.type, c.name,
+           p.id, p.nickname, p.username
+    FROM users s
+    LEFT JOIN LATERAL (
+        SELECT * FROM user_updates
+        WHERE user_id = s.id AND pts > %(pts)s
+        ORDER BY pts
+        LIMIT %(limit)s
+    ) uu ON TRUE
+    LEFT JOIN messages m ON m.id = uu.message_id AND m.created_at = uu.message_at
+    LEFT JOIN users mu ON mu.id = m.user_id
+    LEFT JOIN chats c ON c.id = uu.chat_id AND uu.kind = 'new_chat'
+    LEFT JOIN users p ON p.id = uu.peer_id
+    WHERE s.id = %(user_id)s
+    ORDER BY uu.pts
+"""
+
+
+def serialize_update(row: Tuple) -> Dict[str, Any]:
+    update: Dict[str, Any] = {
+        'pts': row[1],
+        'type': row[2],
+        'chat_id': row[3],
+        'date': row[4].isoformat()
+    }
+    if row[2] == 'new_message':
+        update['message'] = {
+            'id': row[5],
+            'chat_id': row[3],
+            'user_id': row[6],
+            'nickname': row[7],
+            'text': row[8],
+            'created_at': row[9].isoformat()
+        } if row[5] else None
+    elif row[2] == 'new_chat':
+        update['chat'] = {'id': row[3], 'type': row[10], 'name': row[11]} if row[10] else None
+    else:
+        update['user'] = {'id': row[12], 'nickname': row[13], 'username': row[14]} if row[12] else None
+    return update
+
+
+def sweep_user_updates(conn: Any, cur: Any) -> int:
+    '''
+    Deletes updates older than UPDATES_RETENTION_DAYS, UPDATES_SWEEP_BATCH rows
+    per committed batch; concurrent sweepers skip each other's rows. Devices
+    further behind than that get too_long from get_difference.
+    '''
+    removed = 0
+    for _ in range(UPDATES_SWEEP_MAX_BATCHES):
+        cur.execute("""
+            DELETE FROM user_updates WHERE (user_id, pts) IN (
+                SELECT user_id, pts FROM user_updates
+                WHERE created_at < LOCALTIMESTAMP - %s * INTERVAL '1 day'
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+        """, (UPDATES_RETENTION_DAYS, UPDATES_SWEEP_BATCH))
+        conn.commit()
+        removed += cur.rowcount
+        if cur.rowcount < UPDATES_SWEEP_BATCH:
+            break
+    return removed
+
+
+def chat_channel(chat_id: Any) -> str:
+    return f'chat_{int(chat_id)}'
+
+
+def fetch_messages_since(cur: Any, chat_id: Any, since_id: int) -> List[Tuple]:
+    cur.execute("""
+        SELECT m.id, m.user_id, u.nickname, m.text, m.created_at
+        FROM messages m
+        JOIN users u ON m.user_id = u.id
+        WHERE m.chat_id = %s AND m.id > %s
+        ORDER BY m.id ASC
+        LIMIT %s
+    """, (chat_id, since_id, SYNC_BATCH_LIMIT))
+    return cur.fetchall()
+
+
+def wait_for_messages(conn: Any, cur: Any, chat_id: Any, since_id: int, timeout: float) -> List[Tuple]:
+    '''
+    Long-poll: LISTENs on the chat channel that send_message notifies and blocks
+    on the socket until a notification arrives or timeout elapses. The table is
+    re-read once after LISTEN (to close the race with a concurrent send) and
+    once per wake-up, never in a polling loop.
+    '''
+    channel = chat_channel(chat_id)
+    cur.execute(f'LISTEN {channel}')
+    conn.commit()
     try:
-        if method == 'POST':
-            body_data = json.loads(event.get('body', '{}'))
-            action = body_data.get('action')
-            
-            if action == 'create_chat':
-                chat_type = body_data.get('type', 'private')
-                chat_name = body_data.get('name')
-                member_ids = body_data.get('member_ids', [])
-                
-                cur.execute(
-                    "INSERT INTO chats (type, name, created_by) VALUES (%s, %s, %s) RETURNING id",
-                    (chat_type, chat_name, user_id)
-                )
-                chat_id = cur.fetchone()[0]
-                
-                member_ids.append(int(user_id))
-                for member_id in set(member_ids):
-                    cur.execute(
-                        "INSERT INTO chat_members (chat_id, user_id) VALUES (%s, %s)",
-                        (chat_id, member_id)
-                    )
-                
-                conn.commit()
-                
-                return {
-                    'statusCode': 201,
-                    'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                    'body': json.dumps({'success': True, 'chat_id': chat_id}),
-                    'isBase64Encoded': False
-                }
-            
-            elif action == 'send_message':
-                chat_id = body_data.get('chat_id')
-                text = body_data.get('text')
-                
-                cur.execute(
-                    "SELECT 1 FROM chat_members WHERE chat_id = %s AND user_id = %s",
-                    (chat_id, user_id)
-                )
-                if not cur.fetchone():
-                    return {
-                        'statusCode': 403,
-                        'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                        'body': json.dumps({'error': 'Not a member of this chat'}),
-                        'isBase64Encoded': False
-                    }
-                
-                cur.execute(
-                    "INSERT INTO messages (chat_id, user_id, text) VALUES (%s, %s, %s) RETURNING id, created_at",
-                    (chat_id, user_id, text)
-                )
-                msg = cur.fetchone()
-                conn.commit()
-                
-                return {
-                    'statusCode': 201,
-                    'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                    'body': json.dumps({
-                        'id': msg[0],
-                        'chat_id': chat_id,
-                        'user_id': int(user_id),
-                        'text': text,
-                        'created_at': msg[1].isoformat()
-                    }),
-                    'isBase64Encoded': False
-                }
-        
-        elif method == 'GET':
-            query_params = event.get('queryStringParameters', {}) or {}
-            chat_id = query_params.get('chat_id')
-            
-            if chat_id:
-                cur.execute("""
-                    SELECT m.id, m.user_id, u.nickname, m.text, m.created_at
-                    FROM messages m
-                    JOIN users u ON m.user_id = u.id
-                    WHERE m.chat_id = %s
-                    ORDER BY m.created_at ASC
-                    LIMIT 100
-                """, (chat_id,))
-                
-                messages = cur.fetchall()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                    'body': json.dumps([{
-                        'id': m[0],
-                        'user_id': m[1],
-                        'nickname': m[2],
-                        'text': m[3],
-                        'created_at': m[4].isoformat()
-                    } for m in messages]),
-                    'isBase64Encoded': False
-                }
-            else:
-                cur.execute("""
-                    SELECT DISTINCT c.id, c.type, c.name, c.updated_at,
-                           (SELECT COUNT(*) FROM chat_members WHERE chat_id = c.id) as member_count
-                    FROM chats c
-                    JOIN chat_members cm ON c.id = cm.chat_id
-                    WHERE cm.user_id = %s
-                    ORDER BY c.updated_at DESC
-                """, (user_id,))
-                
-                chats = cur.fetchall()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                    'body': json.dumps([{
-                        'id': ch[0],
-                        'type': ch[1],
-                        'name': ch[2],
-                        'updated_at': ch[3].isoformat(),
-                        'member_count': ch[4]
-                    } for ch in chats]),
-                    'isBase64Encoded': False
-                }
-        
-        else:
-            return {
-                'statusCode': 405,
-                'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                'body': json.dumps({'error': 'Method not allowed'}),
-                'isBase64Encoded': False
-            }
-    
+        messages = fetch_messages_since(cur, chat_id, since_id)
+        conn.commit()
+        deadline = time.monotonic() + timeout
+        while not messages:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if select.select([conn], [], [], remaining) == ([], [], []):
+                break
+            conn.poll()
+            if not conn.notifies:
+                continue
+            conn.notifies.clear()
+            messages = fetch_messages_since(cur, chat_id, since_id)
+            conn.commit()
+        return messages
     finally:
-        cur.close()
-        conn.close()
+        cur.execute(f'UNLISTEN {channel}')
+        conn.commit()
+        conn.notifies.clear()
+
+
+# messages is range-partitioned by month on created_at (V0007). Each process
+# makes sure the next PARTITION_MONTHS_AHEAD months exist at most once per
+# PARTITION_CHECK_INTERVAL seconds, on its first write after that.
+PARTITION_MONTHS_AHEAD = int(os.environ.get('PARTITION_MONTHS_AHEAD', '3'))
+PARTITION_CHECK_INTERVAL = float(os.environ.get('PARTITION_CHECK_INTERVAL', '3600'))
+
+_partitions_checked_at: Optional[float] = None
+
+
+def ensure_message_partitions(conn: Any, cur: Any) -> None:
+    global _partitions_checked_at
+    now = time.monotonic()
+    if _partitions_checked_at is not None and now - _partitions_checked_at < PARTITION_CHECK_INTERVAL:
+        return
+    cur.execute(
+        "SELECT create_message_partitions(LOCALTIMESTAMP, LOCALTIMESTAMP + %s * INTERVAL '1 month')",
+        (PARTITION_MONTHS_AHEAD,)
+    )
+    conn.commit()
+    # Only once committed: a failed check is retried on the next write
+    _partitions_checked_at = now
+
+
+HISTORY_DEFAULT_LIMIT = 50
+HISTORY_MAX_LIMIT = 200
+
+# History pages by (created_at, id): the anchor's timestamp bounds created_at,
+# so only the partitions on the requested side of the cursor are scanned and
+# the newest page stops in the newest partition that fills it.
+_HISTORY_TEMPLATE = """
+    SELECT m.id, m.user_id, u.nickname, m.text, m.created_at
+    FROM messages m
+    JOIN users u ON m.user_id = u.id
+    WHERE m.chat_id = %(chat_id)s {anchor}
+    ORDER BY m.created_at {order}, m.id {order}
+    LIMIT %(limit)s
+"""
+HISTORY_NEWEST_SQL = _HISTORY_TEMPLATE.format(anchor='', order='DESC')
+HISTORY_BEFORE_SQL = _HISTORY_TEMPLATE.format(
+    anchor='AND m.created_at <= %(at)s AND (m.created_at, m.id) < (%(at)s, %(id)s)', order='DESC')
+HISTORY_AFTER_SQL = _HISTORY_TEMPLATE.format(
+    anchor='AND m.created_at >= %(at)s AND (m.created_at, m.id) > (%(at)s, %(id)s)', order='ASC')
+
+
+def encode_history_cursor(direction: str, message: Tuple) -> str:
+    import base64
+    cursor = f'{direction}:{message[0]}:{message[4].isoformat()}'
+    return base64.urlsafe_b64encode(cursor.encode()).decode().rstrip('=')
+
+
+def parse_history_cursor(query_params: Dict[str, str]) -> Tuple[str, Optional[int], Optional[str]]:
+    '''
+    Resolves the paging anchor from an opaque cursor or explicit before_id/after_id.
+    Returns (direction, message_id, created_at); ('before', None, None) means the
+    newest page, and created_at is None when only the id is known.
+    Raises ValueError on malformed input.
+    '''
+    import base64
+    from datetime import datetime
+    cursor = query_params.get('cursor')
+    if cursor:
+        decoded = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        direction, _, rest = decoded.partition(':')
+        if direction not in ('before', 'after'):
+            raise ValueError('Unknown cursor direction')
+        message_id, _, created_at = rest.partition(':')
+        return direction, int(message_id), datetime.fromisoformat(created_at).isoformat() if created_at else None
+    if query_params.get('after_id'):
+        return 'after', int(query_params['after_id']), None
+    if query_params.get('before_id'):
+        return 'before', int(query_params['before_id']), None
+    return 'before', None, None
+
+
+EXPORT_DEFAULT_LIMIT = 1000
+EXPORT_MAX_LIMIT = 10000
+EXPORT_COLUMNS = ('id', 'chat_id', 'user_id', 'text', 'created_at')
+EXPORT_HEADERS = {
+    'ndjson': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/x-ndjson',
+               'Access-Control-Expose-Headers': 'X-Next-Cursor'},
+    'csv': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'text/csv; charset=utf-8',
+            'Access-Control-Expose-Headers': 'X-Next-Cursor'}
+}
+
+# Oldest first in (created_at, id) order, so each page reads the partitions
+# from its cursor on; scripts/chat_history.py streams the same rows with COPY.
+EXPORT_SQL = """
+    SELECT id, chat_id, user_id, text, created_at
+    FROM messages
+    WHERE chat_id = %(chat_id)s AND created_at >= %(at)s AND (created_at, id) > (%(at)s, %(id)s)
+    ORDER BY created_at, id
+    LIMIT %(limit)s
+"""
+
+
+def format_export(rows: List[Tuple], export_format: str, header: bool) -> str:
+    '''Rows in EXPORT_COLUMNS order as NDJSON lines or CSV records, the same layout the CLI writes.'''
+    if export_format == 'ndjson':
+        return ''.join(
+            dumps({'id': r[0], 'chat_id': r[1], 'user_id': r[2], 'text': r[3], 'created_at': r[4].isoformat()}) + '\n'
+            for r in rows
+        )
+    import csv
+    import io
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    if header:
+        writer.writerow(EXPORT_COLUMNS)
+    writer.writerows((r[0], r[1], r[2], r[3], r[4].isoformat()) for r in rows)
+    return out.getvalue()
+
+
+SEARCH_CONFIG = 'russian'
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 50
+SEARCH_HEADLINE_OPTIONS = 'StartSel=<mark>, StopSel=</mark>, MaxWords=24, MinWords=8, MaxFragments=2'
+# Planner hint for the search statement only: recent message pages are nearly
+# always cached, and at the default random_page_cost of 4 the planner favours
+# bitmap scans over every global match instead of walking the caller's chats.
+SEARCH_RANDOM_PAGE_COST = float(os.environ.get('SEARCH_RANDOM_PAGE_COST', '1.1'))
+
+# Matches in the caller's chats, best ts_rank_cd first, keyset-paginated on
+# (rank, id). The tsquery is folded into a constant so the planner can weigh
+# idx_messages_search for rare terms against walking the caller's chats by
+# idx_messages_chat_id_id for common ones. Only the returned page is
+# highlighted, and the text is HTML-escaped first so the snippet is safe to
+# render with its <mark> tags.
+_SEARCH_TEMPLATE = """
+    SET LOCAL random_page_cost = %(random_page_cost)s;
+    SELECT h.id, h.chat_id, h.user_id, u.nickname, h.created_at, h.rank,
+           ts_headline(%(config)s::regconfig,
+                       replace(replace(replace(h.text, '&', '&amp;'), '<', '&lt;'), '>', '&gt;'),
+                       websearch_to_tsquery(%(config)s::regconfig, %(search)s), %(headline)s)
+    FROM (
+        SELECT * FROM (
+            SELECT m.id, m.chat_id, m.user_id, m.text, m.created_at,
+                   ts_rank_cd(m.search_vector, websearch_to_tsquery(%(config)s::regconfig, %(search)s)) AS rank
+            FROM messages m
+            WHERE m.search_vector @@ websearch_to_tsquery(%(config)s::regconfig, %(search)s)
+              AND m.chat_id IN (SELECT chat_id FROM chat_members WHERE user_id = %(user_id)s)
+              {chat_filter}
+        ) ranked
+        {cursor_filter}
+        ORDER BY rank DESC, id DESC
+        LIMIT %(limit)s
+    ) h
+    LEFT JOIN users u ON u.id = h.user_id
+    ORDER BY h.rank DESC, h.id DESC
+"""
+
+
+def search_sql(in_chat: bool, after_cursor: bool) -> str:
+    return _SEARCH_TEMPLATE.format(
+        chat_filter='AND m.chat_id = %(chat_id)s' if in_chat else '',
+        cursor_filter='WHERE (rank, id) < (%(rank)s::real, %(id)s)' if after_cursor else ''
+    )
+
+
+def encode_search_cursor(rank: float, message_id: int) -> str:
+    import base64
+    return base64.urlsafe_b64encode(f'{rank!r}:{message_id}'.encode()).decode().rstrip('=')
+
+
+def decode_search_cursor(cursor: Optional[str]) -> Optional[Tuple[float, int]]:
+    '''Returns (rank, message_id) of the last result already seen. Raises ValueError on malformed input.'''
+    if not cursor:
+        return None
+    import base64
+    rank, _, message_id = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode().partition(':')
+    return float(rank), int(message_id)
+
+
+def serialize_message(m: Tuple) -> Dict[str, Any]:
+    return {
+        'id': m[0],
+        'user_id': m[1],
+        'nickname': m[2],
+        'text': m[3],
+        'created_at': m[4].isoformat()
+    }
+
+
+def create_chat(conn: Any, cur: Any, user_id: str, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    chat_type = body_data.get('type', 'private')
+    chat_name = body_data.get('name')
+    member_ids = {int(member_id) for member_id in body_data.get('member_ids', [])}
+    member_ids.add(int(user_id))
+
+    cur.execute(
+        "INSERT INTO chats (type, name, created_by, member_count) VALUES (%s, %s, %s, %s) RETURNING id",
+        (chat_type, chat_name, user_id, len(member_ids))
+    )
+    chat_id = cur.fetchone()[0]
+
+    cur.execute("""
+        WITH members AS (
+            INSERT INTO chat_members (chat_id, user_id)
+            SELECT %s, unnest(%s::int[])
+            ON CONFLICT DO NOTHING
+            RETURNING chat_id, user_id
+        ), updates AS (
+            SELECT user_id, 'new_chat' AS kind, chat_id, NULL::int AS message_id,
+                   NULL::timestamp AS message_at, NULL::int AS peer_id
+            FROM members
+        )""" + APPEND_UPDATES_CTES + """
+        SELECT pts FROM bumped WHERE id = %s
+    """, (chat_id, list(member_ids), user_id))
+    pts = cur.fetchone()[0]
+
+    conn.commit()
+    membership_cache.invalidate_chat(chat_id)
+
+    return respond(201, {'success': True, 'chat_id': chat_id, 'pts': pts, 'pts_count': 1})
+
+
+def send_messages(conn: Any, cur: Any, user_id: str, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    items = body_data.get('messages')
+    if not isinstance(items, list) or not items or len(items) > SEND_BATCH_MAX:
+        return error(400, f'messages must be a list of 1..{SEND_BATCH_MAX} items')
+
+    ensure_message_partitions(conn, cur)
+    results, pts = send_messages_batch(cur, user_id, items)
+    conn.commit()
+    sent = sum(1 for r in results if 'id' in r)
+
+    return respond(201, {
+        'success': sent == len(results),
+        'sent': sent,
+        'failed': len(results) - sent,
+        'pts': pts,
+        'pts_count': sent,
+        'results': results
+    })
+
+
+def send_message(conn: Any, cur: Any, user_id: str, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    text = body_data.get('text')
+    try:
+        chat_id = int(body_data.get('chat_id'))
+    except (TypeError, ValueError):
+        return error(400, 'chat_id and text are required')
+    if not isinstance(text, str) or not text.strip():
+        return error(400, 'chat_id and text are required')
+
+    ensure_message_partitions(conn, cur)
+    cached = SEND_MEMBERSHIP_CHECK == 'cache' and membership_cache.contains(chat_id, int(user_id))
+    cur.execute(SEND_MESSAGE_SQL if cached else SEND_MESSAGE_IF_MEMBER_SQL, {
+        'chat_id': chat_id,
+        'user_id': user_id,
+        'text': text,
+        'preview_length': PREVIEW_LENGTH,
+        'channel': chat_channel(chat_id)
+    })
+    msg = cur.fetchone()
+    if not msg:
+        return error(403, 'Not a member of this chat')
+    conn.commit()
+    if SEND_MEMBERSHIP_CHECK == 'cache' and not cached:
+        membership_cache.add(chat_id, int(user_id))
+
+    return respond(201, {
+        'id': msg[0],
+        'chat_id': chat_id,
+        'user_id': int(user_id),
+        'text': text,
+        'created_at': msg[1].isoformat(),
+        'pts': msg[2],
+        'pts_count': 1
+    })
+
+
+def update_members(conn: Any, cur: Any, user_id: str, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    add = body_data.get('action') == 'add_members'
+    try:
+        chat_id = int(body_data.get('chat_id'))
+        member_ids = sorted({int(m) for m in body_data.get('member_ids', [])})
+    except (TypeError, ValueError):
+        chat_id, member_ids = None, []
+    if not chat_id or not member_ids:
+        return error(400, 'chat_id and member_ids are required')
+
+    cur.execute(
+        "SELECT c.created_by FROM chat_members cm JOIN chats c ON c.id = cm.chat_id WHERE cm.chat_id = %s AND cm.user_id = %s",
+        (chat_id, user_id)
+    )
+    membership = cur.fetchone()
+    removes_others = not add and member_ids != [int(user_id)]
+    if not membership or (removes_others and membership[0] != int(user_id)):
+        return error(403, 'Not allowed to change members of this chat')
+
+    changed, member_count = change_members(cur, chat_id, member_ids, add)
+    conn.commit()
+    membership_cache.invalidate_chat(chat_id)
+
+    return respond(200, {
+        'success': True,
+        'added' if add else 'removed': changed,
+        'member_count': member_count
+    })
+
+
+def mark_read(conn: Any, cur: Any, user_id: str, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        chat_id = int(body_data['chat_id'])
+        message_id = int(body_data['message_id']) if body_data.get('message_id') is not None else None
+    except (KeyError, TypeError, ValueError):
+        return error(400, 'Invalid chat_id or message_id')
+
+    # The read position only moves forward, and never past the chat's last message
+    cur.execute("""
+        UPDATE chat_members cm
+        SET last_read_message_id = GREATEST(
+            cm.last_read_message_id,
+            LEAST(COALESCE(%s, c.last_message_id, 0), COALESCE(c.last_message_id, 0))
+        )
+        FROM chats c
+        WHERE c.id = cm.chat_id AND cm.chat_id = %s AND cm.user_id = %s
+        RETURNING cm.last_read_message_id
+    """, (message_id, chat_id, user_id))
+    row = cur.fetchone()
+    if not row:
+        return error(403, 'Not a member of this chat')
+    conn.commit()
+
+    return respond(200, {'success': True, 'last_read_message_id': row[0]})
+
+
+def sync_messages(conn: Any, cur: Any, user_id: str, query_params: Dict[str, str]) -> Dict[str, Any]:
+    try:
+        chat_id = int(query_params['chat_id'])
+        since_id = int(query_params['since_id'])
+        wait = float(query_params.get('wait') or 0)
+    except ValueError:
+        return error(400, 'Invalid since_id or wait')
+    wait = max(0.0, min(wait, SYNC_MAX_WAIT))
+    if not is_member(cur, chat_id, user_id):
+        return error(403, 'Not a member of this chat')
+
+    messages = fetch_messages_since(cur, chat_id, since_id)
+    if not messages and wait > 0:
+        messages = wait_for_messages(conn, cur, chat_id, since_id, wait)
+
+    return respond(200, {
+        'messages': [serialize_message(m) for m in messages],
+        'last_id': messages[-1][0] if messages else since_id
+    })
+
+
+def get_difference(conn: Any, cur: Any, user_id: str, query_params: Dict[str, str]) -> Dict[str, Any]:
+    '''
+    Everything a device missed across all chats and friendships since its
+    last seen pts, in pts order, one page per query. too_long means the gap
+    can't be replayed (updates already swept, or the device is ahead): the
+    device reloads its chat list and friends, then continues from pts.
+    '''
+    try:
+        pts = int(query_params['pts'])
+        limit = int(query_params.get('limit') or DIFFERENCE_DEFAULT_LIMIT)
+    except ValueError:
+        return error(400, 'Invalid pts or limit')
+    if pts < 0:
+        return error(400, 'Invalid pts or limit')
+    limit = max(1, min(limit, DIFFERENCE_MAX_LIMIT))
+
+    cur.execute(DIFFERENCE_SQL, {'user_id': user_id, 'pts': pts, 'limit': limit + 1})
+    rows = cur.fetchall()
+    state_pts = rows[0][0] if rows else 0
+    updates = [row for row in rows if row[1] is not None]
+    # A user's pts are gapless, so a page that doesn't start right after the
+    # device's pts means the updates in between were swept
+    if pts > state_pts or (updates and updates[0][1] != pts + 1) or (pts < state_pts and not updates):
+        return respond(200, {'updates': [], 'pts': state_pts, 'has_more': False, 'too_long': True})
+
+    has_more = len(updates) > limit
+    updates = updates[:limit]
+    response = respond(200, {
+        'updates': [serialize_update(u) for u in updates],
+        'pts': updates[-1][1] if updates else pts,
+        'has_more': has_more,
+        'too_long': False
+    })
+    if UPDATES_SWEEP_PROBABILITY > 0:
+        import random
+        if random.random() < UPDATES_SWEEP_PROBABILITY:
+            sweep_user_updates(conn, cur)
+    return response
+
+
+def history_etag(cur: Any, user_id: str, query_params: Dict[str, str]) -> Optional[str]:
+    '''
+    Messages are never edited, so a page anchored "before" an existing message
+    only changes when history is imported, archived or restored, which bumps
+    the chat's history_version (V0011). A cursor carries the anchor's
+    timestamp, a bare before_id is looked up, and an unknown one gets no ETag.
+    The newest page and "after" pages also change with the chat's last message id.
+    '''
+    try:
+        chat_id = int(query_params['chat_id'])
+        limit = int(query_params.get('limit') or HISTORY_DEFAULT_LIMIT)
+        direction, anchor_id, anchor_at = parse_history_cursor(query_params)
+    except ValueError:
+        return None
+    page = f'h{chat_id}-{direction}{anchor_id}-{max(1, min(limit, HISTORY_MAX_LIMIT))}'
+    if direction == 'before' and anchor_id is not None and anchor_at is None:
+        cur.execute("SELECT 1 FROM messages WHERE chat_id = %s AND id = %s", (chat_id, anchor_id))
+        if not cur.fetchone():
+            return None
+    cur.execute("SELECT last_message_id, history_version FROM chats WHERE id = %s", (chat_id,))
+    chat = cur.fetchone()
+    if chat is None:
+        return None
+    if direction == 'before' and anchor_id is not None:
+        return f'"{page}-v{chat[1]}"'
+    return f'"{page}-{chat[0]}-v{chat[1]}"'
+
+
+@conditional(history_etag)
+def get_history_page(conn: Any, cur: Any, user_id: str, query_params: Dict[str, str]) -> Dict[str, Any]:
+    chat_id = int(query_params['chat_id'])
+    try:
+        limit = int(query_params.get('limit') or HISTORY_DEFAULT_LIMIT)
+        direction, anchor_id, anchor_at = parse_history_cursor(query_params)
+    except ValueError:
+        return error(400, 'Invalid cursor or limit')
+    limit = max(1, min(limit, HISTORY_MAX_LIMIT))
+
+    if anchor_id is not None and anchor_at is None:
+        cur.execute("SELECT created_at FROM messages WHERE chat_id = %s AND id = %s", (chat_id, anchor_id))
+        anchor = cur.fetchone()
+        if anchor is None and direction == 'before':
+            # Nothing is known to precede an unknown anchor
+            return respond(200, {'messages': [], 'next_cursor': None})
+        # An unknown after anchor (e.g. after_id=0) pages from the oldest message
+        anchor_at = anchor[0] if anchor else '-infinity'
+
+    if anchor_id is None:
+        sql = HISTORY_NEWEST_SQL
+    else:
+        sql = HISTORY_AFTER_SQL if direction == 'after' else HISTORY_BEFORE_SQL
+    cur.execute(sql, {'chat_id': chat_id, 'id': anchor_id, 'at': anchor_at, 'limit': limit + 1})
+
+    messages = cur.fetchall()
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+
+    return respond(200, {
+        'messages': [serialize_message(m) for m in messages],
+        'next_cursor': encode_history_cursor(direction, messages[-1]) if has_more else None
+    })
+
+
+def get_history(conn: Any, cur: Any, user_id: str, query_params: Dict[str, str],
+                if_none_match: Optional[str] = None) -> Dict[str, Any]:
+    '''Checks membership before the conditional page, so a 304 never reveals a chat to outsiders.'''
+    try:
+        chat_id = int(query_params['chat_id'])
+    except ValueError:
+        return error(400, 'Invalid chat id')
+    if not is_member(cur, chat_id, user_id):
+        return error(403, 'Not a member of this chat')
+    return get_history_page(conn, cur, user_id, query_params, if_none_match)
+
+
+get_history.conditional = True
+
+
+def export_history(conn: Any, cur: Any, user_id: str, query_params: Dict[str, str]) -> Dict[str, Any]:
+    '''
+    One page of a chat's complete history, oldest first, as NDJSON or CSV
+    (with a header on the first page). X-Next-Cursor continues the export;
+    the pages concatenate into the file scripts/chat_history.py writes.
+    '''
+    export_format = query_params.get('format') or 'ndjson'
+    try:
+        chat_id = int(query_params['export'])
+        limit = max(1, min(int(query_params.get('limit') or EXPORT_DEFAULT_LIMIT), EXPORT_MAX_LIMIT))
+        direction, anchor_id, anchor_at = parse_history_cursor({'cursor': query_params.get('cursor')})
+    except (ValueError, UnicodeDecodeError):
+        return error(400, 'Invalid chat id, cursor or limit')
+    if export_format not in EXPORT_HEADERS or (anchor_id is not None and (direction != 'after' or anchor_at is None)):
+        return error(400, 'Invalid format or cursor')
+
+    if not is_member(cur, chat_id, user_id):
+        return error(403, 'Not a member of this chat')
+
+    cur.execute(EXPORT_SQL, {
+        'chat_id': chat_id,
+        'at': anchor_at or '-infinity',
+        'id': anchor_id or 0,
+        'limit': limit + 1
+    })
+    rows = cur.fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    headers = EXPORT_HEADERS[export_format]
+    if has_more:
+        headers = {**headers, 'X-Next-Cursor': encode_history_cursor('after', rows[-1])}
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': format_export(rows, export_format, header=anchor_id is None),
+        'isBase64Encoded': False
+    }
+
+
+def search_messages(conn: Any, cur: Any, user_id: str, query_params: Dict[str, str]) -> Dict[str, Any]:
+    search = query_params['search'].strip()
+    try:
+        limit = max(1, min(int(query_params.get('limit') or SEARCH_DEFAULT_LIMIT), SEARCH_MAX_LIMIT))
+        chat_id = int(query_params['chat_id']) if query_params.get('chat_id') else None
+        cursor = decode_search_cursor(query_params.get('cursor'))
+    except (ValueError, UnicodeDecodeError):
+        return error(400, 'Invalid cursor, chat_id or limit')
+    if not search:
+        return error(400, 'search is required')
+
+    cur.execute(search_sql(chat_id is not None, cursor is not None), {
+        'random_page_cost': SEARCH_RANDOM_PAGE_COST,
+        'config': SEARCH_CONFIG,
+        'search': search,
+        'headline': SEARCH_HEADLINE_OPTIONS,
+        'user_id': user_id,
+        'chat_id': chat_id,
+        'rank': cursor[0] if cursor else None,
+        'id': cursor[1] if cursor else None,
+        'limit': limit + 1
+    })
+    rows = cur.fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    return respond(200, {
+        'results': [{
+            'id': r[0],
+            'chat_id': r[1],
+            'user_id': r[2],
+            'nickname': r[3],
+            'created_at': r[4].isoformat(),
+            'rank': r[5],
+            'snippet': r[6]
+        } for r in rows],
+        'next_cursor': encode_search_cursor(rows[-1][5], rows[-1][0]) if has_more else None
+    })
+
+
+def chat_list_etag(cur: Any, user_id: str, query_params: Dict[str, str]) -> Optional[str]:
+    '''
+    Fingerprint of every column the chat list is built from, read from the
+    membership index and chat rows only; unread counts move with
+    last_message_id and last_read_message_id, so messages are never touched.
+    '''
+    cur.execute("""
+        SELECT md5(COALESCE(string_agg(
+            concat_ws(':', c.id, c.name, c.updated_at, c.member_count, c.last_message_id, cm.last_read_message_id),
+            ',' ORDER BY c.id
+        ), ''))
+        FROM chat_members cm
+        JOIN chats c ON c.id = cm.chat_id
+        WHERE cm.user_id = %s
+    """, (user_id,))
+    return f'"cl-{cur.fetchone()[0]}"'
+
+
+@conditional(chat_list_etag)
+def get_chat_list(conn: Any, cur: Any, user_id: str, query_params: Dict[str, str]) -> Dict[str, Any]:
+    cur.execute("""
+        SELECT c.id, c.type, c.name, c.updated_at, c.member_count,
+               c.last_message_id, c.last_message_preview, c.last_message_at,
+               CASE WHEN c.last_message_id > cm.last_read_message_id THEN (
+                   SELECT COUNT(*) FROM (
+                       SELECT 1 FROM messages m
+                       WHERE m.chat_id = c.id AND m.id > cm.last_read_message_id
+                       LIMIT %s
+                   ) unread
+               ) ELSE 0 END AS unread_count
+        FROM chat_members cm
+        JOIN chats c ON c.id = cm.chat_id
+        WHERE cm.user_id = %s
+        ORDER BY c.updated_at DESC
+    """, (UNREAD_COUNT_CAP, user_id))
+
+    return respond(200, [{
+        'id': ch[0],
+        'type': ch[1],
+        'name': ch[2],
+        'updated_at': ch[3].isoformat(),
+        'member_count': ch[4],
+        'last_message': {
+            'id': ch[5],
+            'text': ch[6],
+            'created_at': ch[7].isoformat()
+        } if ch[5] else None,
+        'unread_count': ch[8]
+    } for ch in cur.fetchall()])
+
+
+POST_ACTIONS: Dict[str, Callable[..., Dict[str, Any]]] = {
+    'create_chat': create_chat,
+    'send_message': send_message,
+    'send_messages': send_messages,
+    'add_members': update_members,
+    'remove_members': update_members,
+    'mark_read': mark_read,
+}
+
+# First rule whose query parameters are all present selects the view; the chat list is the default.
+GET_VIEWS: List[Tuple[Tuple[str, ...], Callable[..., Dict[str, Any]]]] = [
+    (('pts',), get_difference),
+    (('export',), export_history),
+    (('search',), search_messages),
+    (('chat_id', 'since_id'), sync_messages),
+    (('chat_id',), get_history),
+]
+
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Manages chats - create private/group chats, get chat list, send messages, sync updates
+    Args: event with httpMethod, headers with Authorization: Bearer <session token>, body with chat data
+    Returns: HTTP response with chat data
+    '''
+    method: str = event.get('httpMethod', 'GET')
+
+    if method == 'OPTIONS':
+        return PREFLIGHT_RESPONSE
+
+    headers = event.get('headers') or {}
+    accept_encoding = headers.get('accept-encoding') or headers.get('Accept-Encoding')
+    user_id, token_presented = authenticate(headers)
+
+    if not user_id:
+        if token_presented:
+            return error(401, 'Invalid or expired session')
+        return error(401, 'User ID required' if SESSION_ALLOW_USER_ID_HEADER else 'Session token required')
+
+    if method == 'POST':
+        body_data = loads(event.get('body') or '{}')
+        action = POST_ACTIONS.get(body_data.get('action'))
+        if action is None:
+            return error(400, 'Invalid action')
+        return run_with_connection(action, user_id, body_data, accept_encoding=accept_encoding)
+
+    if method == 'GET':
+        query_params = event.get('queryStringParameters') or {}
+        view = next(
+            (view for params, view in GET_VIEWS if all(query_params.get(p) not in (None, '') for p in params)),
+            get_chat_list
+        )
+        if getattr(view, 'conditional', False):
+            return run_with_connection(view, user_id, query_params, headers.get('if-none-match') or headers.get('If-None-Match'),
+                                       accept_encoding=accept_encoding)
+        return run_with_connection(view, user_id, query_params, accept_encoding=accept_encoding)
+
+    return error(405, 'Method not allowed')
@@ -1,116 +1,230 @@
-import json
-import os
-import psycopg2
-from typing import Dict, Any
+from typing import Dict, Any, Callable, List, Optional, Tuple
+
+from _runtime import (
+    APPEND_UPDATES_CTES, SESSION_ALLOW_USER_ID_HEADER, authenticate, conditional, error, loads, respond,
+    run_with_connection
+)
+
+PREFLIGHT_RESPONSE = {
+    'statusCode': 200,
+    'headers': {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type, Authorization, X-Auth-Token, X-User-Id, If-None-Match',
+        'Access-Control-Max-Age': '86400'
+    },
+    'body': '',
+    'isBase64Encoded': False
+}
+
+
+# Friendship changes for the per-user update sequence: (user_id, kind, peer_id) rows.
+FRIEND_UPDATES_SQL = """
+    WITH updates AS (
+        SELECT user_id, kind, NULL::int AS chat_id, NULL::int AS message_id,
+               NULL::timestamp AS message_at, peer_id
+        FROM unnest(%s::int[], %s::text[], %s::int[]) AS t(user_id, kind, peer_id)
+    )""" + APPEND_UPDATES_CTES + """
+    SELECT pts FROM bumped WHERE id = %s
+"""
+
+
+def append_friend_updates(cur: Any, user_id: Any, updates: List[Tuple[int, str, int]]) -> Optional[int]:
+    '''Appends the updates and returns the caller's new pts.'''
+    cur.execute(FRIEND_UPDATES_SQL, (
+        [u[0] for u in updates], [u[1] for u in updates], [u[2] for u in updates], user_id
+    ))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+SUGGESTIONS_DEFAULT_LIMIT = 20
+SUGGESTIONS_MAX_LIMIT = 100
+
+# Accepted friends of one user in either direction; takes the user id twice.
+FRIEND_IDS_SQL = """
+    SELECT friend_id AS id FROM friendships WHERE user_id = %s AND status = 'accepted'
+    UNION
+    SELECT user_id FROM friendships WHERE friend_id = %s AND status = 'accepted'
+"""
+
+
+def send_request(conn: Any, cur: Any, user_id: str, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    friend_id = body_data.get('friend_id')
+    cur.execute(
+        "INSERT INTO friendships (user_id, friend_id, status) VALUES (%s, %s, 'pending') ON CONFLICT DO NOTHING RETURNING id",
+        (user_id, friend_id)
+    )
+    pts = None
+    if cur.fetchone():
+        pts = append_friend_updates(cur, user_id, [
+            (int(user_id), 'friend_request_sent', int(friend_id)),
+            (int(friend_id), 'friend_request', int(user_id))
+        ])
+    conn.commit()
+
+    return respond(201, {'success': True, 'message': 'Friend request sent', 'pts': pts})
+
+
+def accept_request(conn: Any, cur: Any, user_id: str, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    friend_id = body_data.get('friend_id')
+    cur.execute(
+        "UPDATE friendships SET status = 'accepted' WHERE user_id = %s AND friend_id = %s AND status <> 'accepted'",
+        (friend_id, user_id)
+    )
+    accepted = cur.rowcount > 0
+    cur.execute(
+        "INSERT INTO friendships (user_id, friend_id, status) VALUES (%s, %s, 'accepted') ON CONFLICT DO NOTHING",
+        (user_id, friend_id)
+    )
+    # Appended before the friends_version bump, which then touches rows already
+    # locked in id order
+    pts = None
+    if accepted:
+        pts = append_friend_updates(cur, user_id, [
+            (int(user_id), 'friend_accepted', int(friend_id)),
+            (int(friend_id), 'friend_accepted', int(user_id))
+        ])
+    # Both friends lists changed: move their ETags on
+    cur.execute("UPDATE users SET friends_version = friends_version + 1 WHERE id IN (%s, %s)", (user_id, friend_id))
+    conn.commit()
+
+    return respond(200, {'success': True, 'message': 'Friend request accepted', 'pts': pts})
+
+
+def get_mutual_friends(conn: Any, cur: Any, user_id: str, query_params: Dict[str, str]) -> Dict[str, Any]:
+    try:
+        other_id = int(query_params['mutual_with'])
+    except ValueError:
+        return error(400, 'Invalid mutual_with')
+
+    cur.execute("""
+        SELECT u.id, u.nickname, u.username
+        FROM users u
+        WHERE u.id IN (""" + FRIEND_IDS_SQL + """)
+          AND u.id IN (""" + FRIEND_IDS_SQL + """)
+        ORDER BY u.id
+    """, (user_id, user_id, other_id, other_id))
+
+    return respond(200, [
+        {'id': u[0], 'nickname': u[1], 'username': u[2]}
+        for u in cur.fetchall()
+    ])
+
+
+def get_suggestions(conn: Any, cur: Any, user_id: str, query_params: Dict[str, str]) -> Dict[str, Any]:
+    try:
+        limit = max(1, min(int(query_params.get('limit') or SUGGESTIONS_DEFAULT_LIMIT), SUGGESTIONS_MAX_LIMIT))
+    except ValueError:
+        return error(400, 'Invalid limit')
+
+    cur.execute("""
+        WITH my_friends AS MATERIALIZED (""" + FRIEND_IDS_SQL + """),
+        friends_of_friends AS (
+            SELECT DISTINCT e.candidate_id, mf.id AS via_id
+            FROM my_friends mf
+            CROSS JOIN LATERAL (
+                SELECT f.friend_id AS candidate_id FROM friendships f
+                WHERE f.user_id = mf.id AND f.status = 'accepted'
+                UNION
+                SELECT f.user_id FROM friendships f
+                WHERE f.friend_id = mf.id AND f.status = 'accepted'
+            ) e
+        ),
+        ranked AS (
+            SELECT candidate_id, COUNT(*) AS mutual_count
+            FROM friends_of_friends fof
+            WHERE candidate_id <> %s
+              AND NOT EXISTS (SELECT 1 FROM my_friends mf WHERE mf.id = fof.candidate_id)
+              AND NOT EXISTS (SELECT 1 FROM friendships x WHERE x.user_id = %s AND x.friend_id = fof.candidate_id)
+              AND NOT EXISTS (SELECT 1 FROM friendships x WHERE x.friend_id = %s AND x.user_id = fof.candidate_id)
+            GROUP BY candidate_id
+            ORDER BY mutual_count DESC, candidate_id
+            LIMIT %s
+        )
+        SELECT u.id, u.nickname, u.username, r.mutual_count
+        FROM ranked r
+        JOIN users u ON u.id = r.candidate_id
+        ORDER BY r.mutual_count DESC, u.id
+    """, (user_id, user_id, user_id, user_id, user_id, limit))
+
+    return respond(200, [
+        {'id': u[0], 'nickname': u[1], 'username': u[2], 'mutual_count': u[3]}
+        for u in cur.fetchall()
+    ])
+
+
+def friends_etag(cur: Any, user_id: str, query_params: Dict[str, str]) -> Optional[str]:
+    cur.execute("SELECT friends_version FROM users WHERE id = %s", (user_id,))
+    user = cur.fetchone()
+    return f'"f{user_id}-{user[0]}"' if user else None
+
+
+@conditional(friends_etag)
+def get_friends(conn: Any, cur: Any, user_id: str, query_params: Dict[str, str]) -> Dict[str, Any]:
+    cur.execute("""
+        SELECT u.id, u.nickname, u.username, f.status
+        FROM friendships f
+        JOIN users u ON (f.friend_id = u.id)
+        WHERE f.user_id = %s AND f.status = 'accepted'
+        UNION
+        SELECT u.id, u.nickname, u.username, f.status
+        FROM friendships f
+        JOIN users u ON (f.user_id = u.id)
+        WHERE f.friend_id = %s AND f.status = 'accepted'
+    """, (user_id, user_id))
+
+    return respond(200, [
+        {'id': f[0], 'nickname': f[1], 'username': f[2], 'status': f[3]}
+        for f in cur.fetchall()
+    ])
+
+
+POST_ACTIONS: Dict[str, Callable[..., Dict[str, Any]]] = {
+    'send_request': send_request,
+    'accept_request': accept_request,
+}
+
+# First query parameter present selects the view; get_friends is the default.
+GET_VIEWS: List[Tuple[str, Callable[..., Dict[str, Any]]]] = [
+    ('mutual_with', get_mutual_friends),
+    ('suggestions', get_suggestions),
+]
+
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Manages friendships - send requests, accept, get friends list
-    Args: event with httpMethod, headers with X-User-Id, body with friend operations
+    Args: event with httpMethod, headers with Authorization: Bearer <session token>, body with friend operations
     Returns: HTTP response with friendship data
     '''
     method: str = event.get('httpMethod', 'GET')
-    
+
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
-    
-    headers = event.get('headers', {})
-    user_id = headers.get('x-user-id') or headers.get('X-User-Id')
-    
+        return PREFLIGHT_RESPONSE
+
+    headers = event.get('headers') or {}
+    accept_encoding = headers.get('accept-encoding') or headers.get('Accept-Encoding')
+    user_id, token_presented = authenticate(headers)
+
     if not user_id:
-        return {
-            'statusCode': 401,
-            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'User ID required in X-User-Id header'}),
-            'isBase64Encoded': False
-        }
-    
-    db_url = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(db_url)
-    cur = conn.cursor()
-    
-    try:
-        if method == 'POST':
-            body_data = json.loads(event.get('body', '{}'))
-            action = body_data.get('action')
-            friend_id = body_data.get('friend_id')
-            
-            if action == 'send_request':
-                cur.execute(
-                    "INSERT INTO friendships (user_id, friend_id, status) VALUES (%s, %s, 'pending') ON CONFLICT DO NOTHING RETURNING id",
-                    (user_id, friend_id)
-                )
-                result = cur.fetchone()
-                conn.commit()
-                
-                return {
-                    'statusCode': 201,
-                    'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                    'body': json.dumps({'success': True, 'message': 'Friend request sent'}),
-                    'isBase64Encoded': False
-                }
-            
-            elif action == 'accept_request':
-                cur.execute(
-                    "UPDATE friendships SET status = 'accepted' WHERE user_id = %s AND friend_id = %s",
-                    (friend_id, user_id)
-                )
-                cur.execute(
-                    "INSERT INTO friendships (user_id, friend_id, status) VALUES (%s, %s, 'accepted') ON CONFLICT DO NOTHING",
-                    (user_id, friend_id)
-                )
-                conn.commit()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                    'body': json.dumps({'success': True, 'message': 'Friend request accepted'}),
-                    'isBase64Encoded': False
-                }
-        
-        elif method == 'GET':
-            cur.execute("""
-                SELECT u.id, u.nickname, u.username, f.status
-                FROM friendships f
-                JOIN users u ON (f.friend_id = u.id)
-                WHERE f.user_id = %s AND f.status = 'accepted'
-                UNION
-                SELECT u.id, u.nickname, u.username, f.status
-                FROM friendships f
-                JOIN users u ON (f.user_id = u.id)
-                WHERE f.friend_id = %s AND f.status = 'accepted'
-            """, (user_id, user_id))
-            
-            friends = cur.fetchall()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                'body': json.dumps([
-                    {'id': f[0], 'nickname': f[1], 'username': f[2], 'status': f[3]}
-                    for f in friends
-                ]),
-                'isBase64Encoded': False
-            }
-        
-        else:
-            return {
-                'statusCode': 405,
-                'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                'body': json.dumps({'error': 'Method not allowed'}),
-                'isBase64Encoded': False
-            }
-    
-    finally:
-        cur.close()
-        conn.close()
+        if token_presented:
+            return error(401, 'Invalid or expired session')
+        return error(401, 'User ID required in X-User-Id header' if SESSION_ALLOW_USER_ID_HEADER else 'Session token required')
+
+    if method == 'POST':
+        body_data = loads(event.get('body') or '{}')
+        action = POST_ACTIONS.get(body_data.get('action'))
+        if action is None:
+            return error(400, 'Invalid action')
+        return run_with_connection(action, user_id, body_data, accept_encoding=accept_encoding)
+
+    if method == 'GET':
+        query_params = event.get('queryStringParameters') or {}
+        view = next((view for param, view in GET_VIEWS if query_params.get(param)), get_friends)
+        if getattr(view, 'conditional', False):
+            return run_with_connection(view, user_id, query_params, headers.get('if-none-match') or headers.get('If-None-Match'),
+                                       accept_encoding=accept_encoding)
+        return run_with_connection(view, user_id, query_params, accept_encoding=accept_encoding)
+
+    return error(405, 'Method not allowed')
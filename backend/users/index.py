@@ -1,7 +1,198 @@
-import json
-import os
-import psycopg2
-from typing import Dict, Any
+from typing import Dict, Any, Callable, List, Optional, Tuple
+
+from _runtime import (
+    JSON_HEADERS, SESSION_KEYS, dumps, error, issue_session_token, loads, normalize_phone, respond,
+    run_with_connection, verify_registration_ticket
+)
+
+PREFLIGHT_RESPONSE = {
+    'statusCode': 200,
+    'headers': {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+        'Access-Control-Max-Age': '86400'
+    },
+    'body': '',
+    'isBase64Encoded': False
+}
+
+
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+SEARCH_MIN_TRIGRAM_LENGTH = 3
+
+
+def escape_like(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def encode_search_cursor(values: List[Any]) -> str:
+    import base64
+    return base64.urlsafe_b64encode(dumps(values).encode()).decode().rstrip('=')
+
+
+def decode_search_cursor(cursor: Optional[str]) -> Optional[List[Any]]:
+    import base64
+    if not cursor:
+        return None
+    values = loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    if not isinstance(values, list):
+        raise ValueError('Malformed cursor')
+    return values
+
+
+def cursor_values(cursor: Optional[List[Any]], mode: str, types: Tuple[type, ...]) -> Optional[List[Any]]:
+    '''
+    The keyset values of a cursor issued by the given search mode. Cursors are
+    [mode, *values]; one from another mode or with values of the wrong types
+    raises ValueError instead of reaching the query.
+    '''
+    if cursor is None:
+        return None
+    if len(cursor) != len(types) + 1 or cursor[0] != mode:
+        raise ValueError('Cursor belongs to another search')
+    values = cursor[1:]
+    for value, expected in zip(values, types):
+        if isinstance(value, bool) or not isinstance(value, expected):
+            raise ValueError('Malformed cursor')
+    return values
+
+
+def search_users(cur: Any, search: str, cursor: Optional[List[Any]], limit: int) -> Tuple[List[Tuple], Optional[str]]:
+    '''
+    Three index-backed modes, each keyset-paginated:
+    - no search: browse by id;
+    - '@name' or fewer than SEARCH_MIN_TRIGRAM_LENGTH chars: username prefix
+      via idx_users_username_prefix, ordered by lower(username);
+    - otherwise: substring match via the pg_trgm GIN indexes, ranked exact >
+      prefix > substring and then by trigram similarity.
+    Returns (rows of (id, nickname, username), next cursor or None).
+    '''
+    query = search.lower()
+    prefix_mode = query.startswith('@') or 0 < len(query) < SEARCH_MIN_TRIGRAM_LENGTH
+    query = query.lstrip('@')
+    
+    if not query:
+        mode = 'id'
+        after = cursor_values(cursor, mode, (int,))
+        cur.execute(
+            "SELECT id, nickname, username FROM users WHERE id > %s ORDER BY id LIMIT %s",
+            (after[0] if after else 0, limit + 1)
+        )
+        rows = cur.fetchall()
+        cursor_fields = (0,)
+    elif prefix_mode:
+        mode = 'prefix'
+        after_name, after_id = cursor_values(cursor, mode, (str, int)) or ('', 0)
+        cur.execute("""
+            SELECT id, nickname, username, lower(username) COLLATE "C" AS name_key
+            FROM users
+            WHERE lower(username) COLLATE "C" LIKE %s
+              AND (lower(username) COLLATE "C", id) > (%s, %s)
+            ORDER BY name_key, id
+            LIMIT %s
+        """, (escape_like(query) + '%', after_name, after_id, limit + 1))
+        rows = cur.fetchall()
+        cursor_fields = (3, 0)
+    else:
+        pattern = '%' + escape_like(query) + '%'
+        mode = 'trigram'
+        after_score, after_id = cursor_values(cursor, mode, ((int, float), int)) or (None, None)
+        cur.execute("""
+            SELECT id, nickname, username, score
+            FROM (
+                SELECT id, nickname, username,
+                       CASE
+                           WHEN lower(username) = %(q)s OR lower(nickname) = %(q)s THEN 3
+                           WHEN lower(username) LIKE %(prefix)s OR lower(nickname) LIKE %(prefix)s THEN 2
+                           ELSE 1
+                       END + GREATEST(similarity(lower(username), %(q)s), similarity(lower(nickname), %(q)s)) AS score
+                FROM users
+                WHERE lower(username) LIKE %(pattern)s OR lower(nickname) LIKE %(pattern)s
+            ) ranked
+            WHERE %(after_score)s::float8 IS NULL
+               OR score < %(after_score)s
+               OR (score = %(after_score)s AND id > %(after_id)s)
+            ORDER BY score DESC, id
+            LIMIT %(limit)s
+        """, {
+            'q': query,
+            'prefix': escape_like(query) + '%',
+            'pattern': pattern,
+            'after_score': after_score,
+            'after_id': after_id,
+            'limit': limit + 1
+        })
+        rows = cur.fetchall()
+        cursor_fields = (3, 0)
+    
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_search_cursor([mode] + [rows[-1][i] for i in cursor_fields])
+
+
+def create_user(conn: Any, cur: Any, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    phone = normalize_phone(body_data.get('phone'))
+    nickname = body_data.get('nickname')
+    username = body_data.get('username')
+
+    if not phone or not nickname or not username:
+        return error(400, 'Phone, nickname and username are required')
+
+    if SESSION_KEYS:
+        ticket = body_data.get('registration_ticket')
+        if not isinstance(ticket, str) or verify_registration_ticket(ticket) != phone:
+            return error(403, 'Verify the phone number before registering')
+
+    cur.execute("SELECT id FROM users WHERE nickname = %s OR username = %s", (nickname, username))
+    existing = cur.fetchone()
+
+    if existing:
+        return error(400, 'Nickname or username already taken')
+
+    cur.execute(
+        "INSERT INTO users (phone, nickname, username) VALUES (%s, %s, %s) RETURNING id, nickname, username, created_at",
+        (phone, nickname, username)
+    )
+    user = cur.fetchone()
+    conn.commit()
+
+    return respond(201, {
+        'id': user[0],
+        'nickname': user[1],
+        'username': user[2],
+        'created_at': user[3].isoformat(),
+        'token': issue_session_token(user[0])
+    })
+
+
+SEARCH_HEADERS = {**JSON_HEADERS, 'Access-Control-Expose-Headers': 'X-Next-Cursor'}
+
+
+def get_users(conn: Any, cur: Any, query_params: Dict[str, str]) -> Dict[str, Any]:
+    search = query_params.get('search', '').strip()
+
+    try:
+        limit = max(1, min(int(query_params.get('limit') or SEARCH_DEFAULT_LIMIT), SEARCH_MAX_LIMIT))
+        cursor = decode_search_cursor(query_params.get('cursor'))
+        users, next_cursor = search_users(cur, search, cursor, limit)
+    except (ValueError, TypeError):
+        return error(400, 'Invalid cursor or limit')
+
+    return respond(
+        200,
+        [{'id': u[0], 'nickname': u[1], 'username': u[2]} for u in users],
+        {**SEARCH_HEADERS, 'X-Next-Cursor': next_cursor} if next_cursor else SEARCH_HEADERS
+    )
+
+
+ROUTES: Dict[str, Callable[..., Dict[str, Any]]] = {
+    'POST': create_user,
+    'GET': get_users,
+}
+
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
@@ -10,109 +201,16 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     Returns: HTTP response with user data or error
     '''
     method: str = event.get('httpMethod', 'GET')
-    
+
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
-    
-    db_url = os.environ.get('DATABASE_URL')
-    if not db_url:
-        return {
-            'statusCode': 500,
-            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'Database not configured'}),
-            'isBase64Encoded': False
-        }
-    
-    conn = psycopg2.connect(db_url)
-    cur = conn.cursor()
-    
-    try:
-        if method == 'POST':
-            body_data = json.loads(event.get('body', '{}'))
-            phone = body_data.get('phone')
-            nickname = body_data.get('nickname')
-            username = body_data.get('username')
-            
-            if not phone or not nickname or not username:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                    'body': json.dumps({'error': 'Phone, nickname and username are required'}),
-                    'isBase64Encoded': False
-                }
-            
-            cur.execute("SELECT id FROM users WHERE nickname = %s OR username = %s", (nickname, username))
-            existing = cur.fetchone()
-            
-            if existing:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                    'body': json.dumps({'error': 'Nickname or username already taken'}),
-                    'isBase64Encoded': False
-                }
-            
-            cur.execute(
-                "INSERT INTO users (phone, nickname, username) VALUES (%s, %s, %s) RETURNING id, nickname, username, created_at",
-                (phone, nickname, username)
-            )
-            user = cur.fetchone()
-            conn.commit()
-            
-            return {
-                'statusCode': 201,
-                'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                'body': json.dumps({
-                    'id': user[0],
-                    'nickname': user[1],
-                    'username': user[2],
-                    'created_at': user[3].isoformat()
-                }),
-                'isBase64Encoded': False
-            }
-        
-        elif method == 'GET':
-            query_params = event.get('queryStringParameters', {}) or {}
-            search = query_params.get('search', '')
-            
-            if search:
-                cur.execute(
-                    "SELECT id, nickname, username FROM users WHERE username ILIKE %s OR nickname ILIKE %s LIMIT 20",
-                    (f'%{search}%', f'%{search}%')
-                )
-            else:
-                cur.execute("SELECT id, nickname, username FROM users LIMIT 20")
-            
-            users = cur.fetchall()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                'body': json.dumps([
-                    {'id': u[0], 'nickname': u[1], 'username': u[2]}
-                    for u in users
-                ]),
-                'isBase64Encoded': False
-            }
-        
-        else:
-            return {
-                'statusCode': 405,
-                'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                'body': json.dumps({'error': 'Method not allowed'}),
-                'isBase64Encoded': False
-            }
-    
-    finally:
-        cur.close()
-        conn.close()
+        return PREFLIGHT_RESPONSE
+
+    route = ROUTES.get(method)
+    if route is None:
+        return error(405, 'Method not allowed')
+
+    headers = event.get('headers') or {}
+    accept_encoding = headers.get('accept-encoding') or headers.get('Accept-Encoding')
+    if method == 'POST':
+        return run_with_connection(route, loads(event.get('body') or '{}'), accept_encoding=accept_encoding)
+    return run_with_connection(route, event.get('queryStringParameters') or {}, accept_encoding=accept_encoding)
@@ -0,0 +1,132 @@
+'''
+Bytes saved and CPU spent compressing history pages and user search results.
+
+Usage:
+    python bench/bench_compression.py [--pages 200] [--limit 50]
+    DATABASE_URL=postgresql://... python bench/bench_compression.py --with-db --chats 1,2,3
+
+Without --with-db the pages are synthetic: --limit messages of 3-30 mixed
+Cyrillic/Latin words each, serialized through the chats handler's own
+serialize_message and respond. With --with-db every page is a real
+GET /chats?chat_id=&limit= (and /users?search=) response from DATABASE_URL,
+paged back through next_cursor. Each page is then compressed with gzip and,
+when the brotli module is installed, brotli at several levels. The report
+shows payload bytes before and after (on the wire, and base64 as returned to
+the gateway) plus CPU microseconds per page.
+'''
+import argparse
+import base64
+import gzip
+import json
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List
+
+from common import load_handler, make_event
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+WORDS = ('привет как дела сегодня завтра встреча проект отправил посмотри файл спасибо хорошо '
+         'конечно давай созвонимся вечером ok yes deploy build release ticket review merge '
+         'ссылка https://example.com/doc картинка 👍 😂 ага понял сделаю минуту').split()
+
+
+def synthetic_pages(chats: Any, pages: int, limit: int, rng: random.Random) -> List[str]:
+    bodies = []
+    message_id = 10_000_000
+    created_at = datetime(2026, 10, 1, 12, 0, 0)
+    for _ in range(pages):
+        messages = []
+        for _ in range(limit):
+            message_id -= rng.randint(1, 40)
+            created_at -= timedelta(seconds=rng.expovariate(1 / 90))
+            user_id = rng.randint(1, 30)
+            text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 30)))
+            messages.append((message_id, user_id, f'User {user_id}', text, created_at))
+        bodies.append(chats.respond(200, {
+            'messages': [chats.serialize_message(m) for m in messages],
+            'next_cursor': chats.encode_history_cursor('before', messages[-1])
+        })['body'])
+    return bodies
+
+
+def db_pages(args: Any) -> Dict[str, List[str]]:
+    env = {'TRACE_SAMPLE_RATE': '0'}
+    chats = load_handler('chats', env)
+    users = load_handler('users', env)
+    history = []
+    for chat_id in args.chats.split(','):
+        query = {'chat_id': chat_id, 'limit': str(args.limit)}
+        while len(history) < args.pages:
+            response = chats.handler(make_event('GET', query=query, headers={'X-User-Id': args.user_id}), None)
+            if response['statusCode'] != 200:
+                break
+            history.append(response['body'])
+            cursor = json.loads(response['body'])['next_cursor']
+            if not cursor:
+                break
+            query = {'chat_id': chat_id, 'limit': str(args.limit), 'cursor': cursor}
+    search = []
+    for prefix in args.searches.split(','):
+        response = users.handler(make_event('GET', query={'search': prefix, 'limit': '100'}), None)
+        if response['statusCode'] == 200:
+            search.append(response['body'])
+    return {'history': history, 'user search': search}
+
+
+def codecs() -> List[Any]:
+    result = [(f'gzip-{level}', lambda data, level=level: gzip.compress(data, level, mtime=0)) for level in (1, 6, 9)]
+    if brotli is not None:
+        result += [(f'br-{quality}', lambda data, quality=quality: brotli.compress(
+            data, mode=brotli.MODE_TEXT, quality=quality)) for quality in (1, 4, 6, 11)]
+    return result
+
+
+def measure(label: str, bodies: List[str], codec: Callable[[bytes], bytes], repeat: int) -> str:
+    raw = [body.encode() for body in bodies]
+    compressed = [codec(data) for data in raw]
+    started = time.process_time()
+    for _ in range(repeat):
+        for data in raw:
+            base64.b64encode(codec(data))
+    cpu_us = (time.process_time() - started) / (repeat * len(raw)) * 1e6
+    raw_total = sum(len(data) for data in raw)
+    wire_total = sum(len(data) for data in compressed)
+    b64_total = sum((len(data) + 2) // 3 * 4 for data in compressed)
+    return (f'{label:<8} raw={raw_total / len(raw):8.0f}B wire={wire_total / len(raw):7.0f}B '
+            f'({100.0 * (1 - wire_total / raw_total):5.1f}% saved) base64={b64_total / len(raw):7.0f}B '
+            f'cpu={cpu_us:8.1f}us/page')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--limit', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--random-seed', type=int, default=1)
+    parser.add_argument('--with-db', action='store_true')
+    parser.add_argument('--chats', default='1', help='comma-separated chat ids to page through (--with-db)')
+    parser.add_argument('--user-id', default='1', help='member of --chats sending the requests (--with-db)')
+    parser.add_argument('--searches', default='a,al,user', help='comma-separated user search prefixes (--with-db)')
+    args = parser.parse_args()
+
+    if args.with_db:
+        sets = db_pages(args)
+    else:
+        chats = load_handler('chats', {'TRACE_SAMPLE_RATE': '0'})
+        sets = {'history': synthetic_pages(chats, args.pages, args.limit, random.Random(args.random_seed))}
+
+    for name, bodies in sets.items():
+        if not bodies:
+            continue
+        print(f'{name}: {len(bodies)} pages')
+        for label, codec in codecs():
+            print('  ' + measure(label, bodies, codec, args.repeat))
+
+
+if __name__ == '__main__':
+    main()
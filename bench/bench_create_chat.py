@@ -0,0 +1,151 @@
+'''
+Group-creation latency as member count grows, and send contention in big groups.
+
+Usage:
+    DATABASE_URL=postgresql://... python bench/bench_create_chat.py [--sizes 10,100,1000,5000] \
+        [--senders 8] [--sends 50]
+
+Members are real users (phones prefixed with 'cb', seeded on first run), so
+every create_chat and send_message also takes its members' users rows for
+the pts bump (APPEND_UPDATES_CTES), as in production.
+
+For every size it times:
+- create_chat through the chats handler (single unnest INSERT) and, for
+  contrast, the old one-INSERT-per-member loop run directly over psycopg2;
+- send contention: --senders threads each send --sends messages to a chat
+  of their own. With "shared" members all the chats have the same members,
+  so every send locks the same users rows (in id order) and the sends
+  queue behind each other. With "disjoint" members no two chats share a
+  user. The gap between the two is the cost of that lock, in throughput
+  and latency.
+The created rows are deleted afterwards; --cleanup also removes the seeded users.
+'''
+import argparse
+import json
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import psycopg2
+
+from common import database_url, format_stats, load_handler, make_event, percentile, time_calls
+
+BENCH_PHONE_PREFIX = 'cb'
+
+
+def seed_users(conn, count: int) -> List[int]:
+    '''Ids of count bench users, inserting the missing ones.'''
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO users (phone, nickname, username)
+        SELECT %(prefix)s || n, 'Chat bench ' || n, 'cb_' || n FROM generate_series(1, %(count)s) n
+        ON CONFLICT DO NOTHING
+    """, {'prefix': BENCH_PHONE_PREFIX, 'count': count})
+    cur.execute("SELECT id FROM users WHERE phone LIKE %s ORDER BY id LIMIT %s", (BENCH_PHONE_PREFIX + '%', count))
+    ids = [row[0] for row in cur.fetchall()]
+    conn.commit()
+    cur.close()
+    return ids
+
+
+def legacy_create_chat(conn, creator: int, member_ids):
+    cur = conn.cursor()
+    cur.execute("INSERT INTO chats (type, name, created_by) VALUES ('group', 'bench', %s) RETURNING id", (creator,))
+    chat_id = cur.fetchone()[0]
+    for member_id in member_ids:
+        cur.execute("INSERT INTO chat_members (chat_id, user_id) VALUES (%s, %s)", (chat_id, member_id))
+    conn.commit()
+    cur.close()
+
+
+def create_chat(chats, creator: int, member_ids) -> int:
+    event = make_event('POST', headers={'X-User-Id': str(creator)}, body={
+        'action': 'create_chat', 'type': 'group', 'name': 'bench', 'member_ids': member_ids,
+    })
+    response = chats.handler(event, None)
+    if response['statusCode'] != 201:
+        raise SystemExit(f'create_chat failed: {response["body"]}')
+    return json.loads(response['body'])['chat_id']
+
+
+def concurrent_sends(chats, senders: List[int], chat_ids: List[int], sends: int) -> Dict[str, float]:
+    '''Every sender sends sends messages to its chat, all at once; latency stats plus throughput.'''
+    def run(sender: int, chat_id: int) -> List[float]:
+        event = make_event('POST', headers={'X-User-Id': str(sender)}, body={
+            'action': 'send_message', 'chat_id': chat_id, 'text': 'bench',
+        })
+        samples = []
+        for _ in range(sends):
+            started = time.perf_counter()
+            chats.handler(event, None)
+            samples.append((time.perf_counter() - started) * 1000.0)
+        return samples
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(chat_ids)) as pool:
+        samples = [s for result in pool.map(run, senders, chat_ids) for s in result]
+    elapsed = time.perf_counter() - started
+    return {
+        'iterations': len(samples),
+        'mean_ms': statistics.fmean(samples),
+        'p50_ms': percentile(samples, 50),
+        'p95_ms': percentile(samples, 95),
+        'p99_ms': percentile(samples, 99),
+        'per_sec': len(samples) / elapsed,
+    }
+
+
+def cleanup(conn, drop_users: bool = False):
+    cur = conn.cursor()
+    cur.execute("""
+        WITH bench_chats AS (DELETE FROM chats WHERE name = 'bench' RETURNING id),
+        members AS (DELETE FROM chat_members WHERE chat_id IN (SELECT id FROM bench_chats))
+        DELETE FROM messages WHERE chat_id IN (SELECT id FROM bench_chats)
+    """)
+    cur.execute("""
+        DELETE FROM user_updates WHERE user_id IN (SELECT id FROM users WHERE phone LIKE %s)
+    """, (BENCH_PHONE_PREFIX + '%',))
+    if drop_users:
+        cur.execute("DELETE FROM users WHERE phone LIKE %s", (BENCH_PHONE_PREFIX + '%',))
+    conn.commit()
+    cur.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10,100,1000,5000')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--senders', type=int, default=8, help='concurrent senders, one chat each')
+    parser.add_argument('--sends', type=int, default=50, help='messages per sender')
+    parser.add_argument('--cleanup', action='store_true', help='also delete the seeded users')
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(',')]
+    chats = load_handler('chats', {'TRACE_SAMPLE_RATE': '0', 'DB_POOL_SIZE': str(args.senders)})
+    conn = psycopg2.connect(database_url())
+    # Senders first, then a disjoint block of members per sender
+    users = seed_users(conn, args.senders + max(sizes) * args.senders)
+    senders, members = users[:args.senders], users[args.senders:]
+    try:
+        for size in sizes:
+            member_ids = members[:size]
+            stats = time_calls(lambda: create_chat(chats, senders[0], member_ids), args.iterations, warmup=1)
+            print(format_stats(f'set-based members={size}', stats))
+            stats = time_calls(lambda: legacy_create_chat(conn, senders[0], member_ids), args.iterations, warmup=1)
+            print(format_stats(f'per-row loop members={size}', stats))
+            cleanup(conn)
+
+            for label, blocks in (('shared', [member_ids] * args.senders),
+                                  ('disjoint', [members[i * size:(i + 1) * size] for i in range(args.senders)])):
+                chat_ids = [create_chat(chats, sender, block) for sender, block in zip(senders, blocks)]
+                stats = concurrent_sends(chats, senders, chat_ids, args.sends)
+                print(format_stats(f'sends {label} members={size}', stats) + f" {stats['per_sec']:8.1f}/s")
+                cleanup(conn)
+    finally:
+        cleanup(conn, args.cleanup)
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+'''
+Scaling benchmark for mutual friends and "people you may know".
+
+Usage:
+    DATABASE_URL=postgresql://... python bench/bench_friend_graph.py [--users 200000 --degree 30]
+
+Builds a synthetic graph (deterministic from --seed): every user gets about
+--degree random friends, and one hub user per entry of --hub-degrees gets
+exactly that many. Edges are stored in both directions as accepted, like
+accept_request does, and loaded with COPY. Suggestions and mutual friends
+are then timed for each hub.
+'''
+import argparse
+import io
+import random
+
+import psycopg2
+
+from common import database_url, format_stats, load_handler, make_event, time_calls
+
+ID_BASE = 20_000_000
+
+
+def build_edges(users: int, degree: int, hub_degrees, rng: random.Random):
+    edges = set()
+    for user in range(users):
+        for _ in range(degree // 2):
+            other = rng.randrange(users)
+            if other != user:
+                edges.add((min(user, other), max(user, other)))
+    hubs = []
+    for hub, hub_degree in enumerate(hub_degrees):
+        for other in rng.sample(range(len(hub_degrees), users), hub_degree):
+            edges.add((hub, other))
+        hubs.append(hub)
+    return edges, hubs
+
+
+def load_graph(conn, users: int, edges) -> None:
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO users (id, phone, nickname, username)
+        SELECT n, 'g' || n, 'graph ' || n, 'graph_' || n
+        FROM generate_series(%s, %s) n
+        ON CONFLICT DO NOTHING
+    """, (ID_BASE, ID_BASE + users - 1))
+    buf = io.StringIO()
+    for a, b in edges:
+        buf.write(f'{ID_BASE + a}\t{ID_BASE + b}\taccepted\n{ID_BASE + b}\t{ID_BASE + a}\taccepted\n')
+    buf.seek(0)
+    cur.copy_from(buf, 'friendships', columns=('user_id', 'friend_id', 'status'))
+    cur.execute('ANALYZE friendships')
+    conn.commit()
+    cur.close()
+
+
+def cleanup(conn, users: int) -> None:
+    cur = conn.cursor()
+    cur.execute('DELETE FROM friendships WHERE user_id BETWEEN %s AND %s', (ID_BASE, ID_BASE + users - 1))
+    cur.execute('DELETE FROM users WHERE id BETWEEN %s AND %s', (ID_BASE, ID_BASE + users - 1))
+    conn.commit()
+    cur.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200_000)
+    parser.add_argument('--degree', type=int, default=30)
+    parser.add_argument('--hub-degrees', default='10,100,1000,5000')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    hub_degrees = [int(d) for d in args.hub_degrees.split(',')]
+    edges, hubs = build_edges(args.users, args.degree, hub_degrees, random.Random(args.seed))
+    conn = psycopg2.connect(database_url())
+    load_graph(conn, args.users, edges)
+    friends = load_handler('friends')
+    try:
+        for hub, hub_degree in zip(hubs, hub_degrees):
+            headers = {'X-User-Id': str(ID_BASE + hub)}
+            suggestions = make_event('GET', headers=headers, query={'suggestions': '1'})
+            mutual = make_event('GET', headers=headers, query={'mutual_with': str(ID_BASE + len(hubs))})
+            print(format_stats(f'suggestions degree={hub_degree}', time_calls(lambda: friends.handler(suggestions, None), args.iterations)))
+            print(format_stats(f'mutual degree={hub_degree}', time_calls(lambda: friends.handler(mutual, None), args.iterations)))
+    finally:
+        cleanup(conn, args.users)
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+'''
+Message search latency on a large seeded corpus.
+
+Usage:
+    DATABASE_URL=postgresql://... python bench/bench_message_search.py --seed 20000000
+
+--seed inserts that many synthetic messages into --chats bench chats, in
+batches of --batch rows, spread over the last 12 months so every monthly
+partition gets its share. The text is 4-14 words drawn from a 3375-word
+Cyrillic vocabulary with a Zipf-like (log-uniform) distribution, so there
+are very common words as well as rare ones. Two callers are timed: a typical
+one in --member-chats chats, and a heavy one in ten times as many. Each query
+runs through the chats handler's ?search= view. --cleanup removes the bench
+rows afterwards.
+'''
+import argparse
+import math
+import time
+
+import psycopg2
+
+from common import database_url, format_stats, load_handler, make_event, time_calls
+
+SYLLABLES = ['ка', 'ло', 'ми', 'ре', 'ту', 'ны', 'за', 'ве', 'до', 'пи', 'со', 'ру', 'ле', 'жа', 'бо']
+VOCABULARY = len(SYLLABLES) ** 3
+BENCH_PHONE_PREFIX = 'fts'
+BENCH_USERS = 1000
+
+
+def word(k: int) -> str:
+    '''The k-th vocabulary word; small k are the frequent ones.'''
+    return SYLLABLES[k % 15] + SYLLABLES[(k // 15) % 15] + SYLLABLES[(k // 225) % 15]
+
+
+def seed(conn, args) -> None:
+    cur = conn.cursor()
+    cur.execute("SET synchronous_commit = off")
+    cur.execute("""
+        INSERT INTO users (phone, nickname, username)
+        SELECT %(prefix)s || n, 'Search bench ' || n, 'fts_' || n FROM generate_series(1, %(users)s) n
+        ON CONFLICT DO NOTHING
+    """, {'prefix': BENCH_PHONE_PREFIX, 'users': BENCH_USERS})
+    cur.execute("SELECT MIN(id) FROM users WHERE phone LIKE %s", (BENCH_PHONE_PREFIX + '%',))
+    first_user = cur.fetchone()[0]
+    cur.execute("""
+        INSERT INTO chats (type, name, created_by)
+        SELECT 'group', 'Search bench ' || c, %s FROM generate_series(1, %s) c
+        RETURNING id
+    """, (first_user, args.chats))
+    chat_ids = sorted(row[0] for row in cur.fetchall())
+    first_chat = chat_ids[0]
+    # Caller 1 (typical) and caller 2 (heavy) join every k-th chat
+    cur.execute("""
+        INSERT INTO chat_members (chat_id, user_id)
+        SELECT %(first)s + c * (%(chats)s / %(n)s), %(user)s FROM generate_series(0, %(n)s - 1) c
+        UNION ALL
+        SELECT %(first)s + c * (%(chats)s / (%(n)s * 10)), %(user)s + 1 FROM generate_series(0, %(n)s * 10 - 1) c
+        ON CONFLICT DO NOTHING
+    """, {'first': first_chat, 'chats': args.chats, 'n': args.member_chats, 'user': first_user})
+    cur.execute("SELECT create_message_partitions(LOCALTIMESTAMP - INTERVAL '12 months', LOCALTIMESTAMP)")
+    conn.commit()
+
+    syllables = 'ARRAY[' + ','.join(f"'{s}'" for s in SYLLABLES) + ']'
+    span_seconds = 365 * 24 * 3600 / args.seed
+    for lo in range(1, args.seed + 1, args.batch):
+        hi = min(args.seed, lo + args.batch - 1)
+        started = time.perf_counter()
+        cur.execute(f"""
+            INSERT INTO messages (chat_id, user_id, text, created_at)
+            SELECT %(first_chat)s + n %% %(chats)s,
+                   %(first_user)s + n %% %(users)s,
+                   (SELECT string_agg(s[1 + k %% 15] || s[1 + (k / 15) %% 15] || s[1 + (k / 225) %% 15], ' ')
+                    FROM (SELECT floor(exp(random() * ln(%(vocabulary)s)))::int AS k
+                          FROM generate_series(1, 4 + n %% 11)) w),
+                   LOCALTIMESTAMP - (%(total)s - n) * %(span)s * INTERVAL '1 second'
+            FROM generate_series(%(lo)s, %(hi)s) n, (SELECT {syllables} AS s) syl
+        """, {'first_chat': first_chat, 'chats': args.chats, 'first_user': first_user, 'users': BENCH_USERS,
+              'vocabulary': VOCABULARY, 'total': args.seed, 'span': span_seconds, 'lo': lo, 'hi': hi})
+        conn.commit()
+        print(f'seeded {hi} / {args.seed} messages ({time.perf_counter() - started:.1f}s for this batch)', flush=True)
+    cur.execute('ANALYZE messages')
+    conn.commit()
+    cur.close()
+
+
+def cleanup(conn) -> None:
+    cur = conn.cursor()
+    cur.execute("""
+        WITH bench_chats AS (DELETE FROM chats WHERE name LIKE 'Search bench %' RETURNING id),
+        members AS (DELETE FROM chat_members WHERE chat_id IN (SELECT id FROM bench_chats))
+        DELETE FROM messages WHERE chat_id IN (SELECT id FROM bench_chats)
+    """)
+    cur.execute("DELETE FROM users WHERE phone LIKE %s", (BENCH_PHONE_PREFIX + '%',))
+    conn.commit()
+    cur.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seed', type=int, default=0, help='messages to insert before timing')
+    parser.add_argument('--chats', type=int, default=200_000)
+    parser.add_argument('--member-chats', type=int, default=50)
+    parser.add_argument('--batch', type=int, default=1_000_000)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--cleanup', action='store_true')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(database_url())
+    if args.seed:
+        seed(conn, args)
+    cur = conn.cursor()
+    cur.execute("SELECT MIN(id) FROM users WHERE phone LIKE %s", (BENCH_PHONE_PREFIX + '%',))
+    first_user = cur.fetchone()[0]
+    cur.execute("""
+        SELECT MIN(cm.chat_id) FROM chat_members cm WHERE cm.user_id = %s
+    """, (first_user + 1,))
+    heavy_chat = cur.fetchone()[0]
+    conn.rollback()
+    cur.close()
+
+    chats = load_handler('chats', {'TRACE_SAMPLE_RATE': '0'})
+    # Expected share of messages containing the k-th word at least once, for the labels
+    share = lambda k: 1 - (1 - math.log((k + 1) / k) / math.log(VOCABULARY)) ** 9
+    queries = [
+        (f'common {word(1)} (~{share(1):.0%})', word(1), None),
+        (f'frequent {word(20)} (~{share(20):.1%})', word(20), None),
+        (f'medium {word(300)} (~{share(300):.2%})', word(300), None),
+        (f'rare {word(3000)} (~{share(3000):.3%})', word(3000), None),
+        ('two words', f'{word(1)} {word(300)}', None),
+        ('phrase', f'"{word(2)} {word(3)}"', None),
+        ('or + negation', f'{word(40)} or {word(41)} -{word(1)}', None),
+        ('common, one chat', word(1), heavy_chat),
+    ]
+    try:
+        for caller, user_id in (('typical', first_user), ('heavy', first_user + 1)):
+            for label, search, chat_id in queries:
+                query = {'search': search}
+                if chat_id:
+                    query['chat_id'] = str(chat_id)
+                event = make_event('GET', headers={'X-User-Id': str(user_id)}, query=query)
+                print(format_stats(f'{caller:<8} {label}', time_calls(lambda: chats.handler(event, None), args.iterations)))
+                page = chats.loads(chats.handler(event, None)['body'])
+                if page['next_cursor']:
+                    event = make_event('GET', headers={'X-User-Id': str(user_id)},
+                                       query={**query, 'cursor': page['next_cursor']})
+                    print(format_stats(f'{caller:<8} {label} p2', time_calls(lambda: chats.handler(event, None), args.iterations)))
+    finally:
+        if args.cleanup:
+            cleanup(conn)
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+'''
+Compares per-request psycopg2.connect against the module-level connection pool.
+
+Usage:
+    DATABASE_URL=postgresql://... python bench/bench_pool.py [--iterations 500]
+
+DB_POOL_SIZE=0 reproduces the old connect-per-request behaviour; any positive
+size keeps warm connections between handler invocations.
+'''
+import argparse
+
+from common import format_stats, load_handler, make_event, time_calls
+
+SCENARIOS = {
+    'users': make_event('GET', query={'search': 'test'}),
+    'friends': make_event('GET', headers={'X-User-Id': '1'}),
+    'chats': make_event('GET', headers={'X-User-Id': '1'}),
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=500)
+    parser.add_argument('--pool-size', default='4')
+    args = parser.parse_args()
+
+    for name, event in SCENARIOS.items():
+        for label, size in (('connect-per-request', '0'), ('pooled', args.pool_size)):
+            module = load_handler(name, {'DB_POOL_SIZE': size})
+            stats = time_calls(lambda: module.handler(event, None), args.iterations)
+            print(format_stats(f'{name} {label}', stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+'''
+Cold-start import time and per-request CPU of each handler, compared with an
+older revision of the same file.
+
+Usage:
+    python bench/bench_runtime.py [--baseline-ref ce13206] [--with-db]
+
+Import time is measured in a fresh interpreter per sample (so psycopg2 and
+friends are not already cached). Per-request CPU uses time.process_time over
+OPTIONS preflights and, with --with-db, one GET per handler against
+DATABASE_URL.
+'''
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import BACKEND_DIR, load_module, make_event, percentile
+
+HANDLERS = ['auth', 'chats', 'friends', 'users']
+IMPORT_SNIPPET = '''
+import importlib.util, os, sys, time
+sys.path.insert(0, os.path.dirname(os.path.abspath(sys.argv[1])))
+started = time.perf_counter()
+spec = importlib.util.spec_from_file_location('handler_under_test', sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+print((time.perf_counter() - started) * 1000.0)
+'''
+DB_EVENTS = {
+    'auth': make_event('POST', body={'action': 'verify_code', 'phone': '+70000000000', 'code': '000000'}),
+    'chats': make_event('GET', headers={'X-User-Id': '1'}),
+    'friends': make_event('GET', headers={'X-User-Id': '1'}),
+    'users': make_event('GET', query={'search': 'test'}),
+}
+
+
+def import_ms(path: str, samples: int) -> float:
+    results = []
+    for _ in range(samples):
+        out = subprocess.run([sys.executable, '-c', IMPORT_SNIPPET, path], capture_output=True, text=True, check=True)
+        results.append(float(out.stdout.strip()))
+    return percentile(results, 50)
+
+
+def request_cpu_us(module, event, iterations: int) -> float:
+    started = time.process_time()
+    for _ in range(iterations):
+        module.handler(event, None)
+    return (time.process_time() - started) / iterations * 1e6
+
+
+def baseline_file(ref: str, name: str, tmpdir: str) -> str:
+    source = subprocess.run(['git', 'show', f'{ref}:backend/{name}/index.py'], capture_output=True, text=True, check=True)
+    path = os.path.join(tmpdir, name, 'index.py')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(source.stdout)
+    return path
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--baseline-ref', default='ce13206')
+    parser.add_argument('--samples', type=int, default=10)
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--with-db', action='store_true')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name in HANDLERS:
+            current = os.path.join(BACKEND_DIR, name, 'index.py')
+            baseline = baseline_file(args.baseline_ref, name, tmpdir)
+            print(f'{name:<8} import p50: baseline={import_ms(baseline, args.samples):7.2f}ms '
+                  f'current={import_ms(current, args.samples):7.2f}ms')
+
+            options = make_event('OPTIONS')
+            rows = []
+            for label, path in (('baseline', baseline), ('current', current)):
+                module = load_module(path)
+                row = f'options={request_cpu_us(module, options, args.iterations):8.2f}us'
+                if args.with_db:
+                    row += f' db_request={request_cpu_us(module, DB_EVENTS[name], args.iterations // 10):8.2f}us'
+                rows.append(f'{label}: {row}')
+            print(f'{name:<8} cpu/request ' + ' | '.join(rows))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+'''
+User search latency on a large seeded users table.
+
+Usage:
+    DATABASE_URL=postgresql://... python bench/bench_user_search.py --seed 3000000
+
+--seed inserts that many synthetic users (phones prefixed with 'b') with
+generate_series before timing; --cleanup removes them afterwards. Each query
+is timed through the users handler and against the old ILIKE '%q%' scan.
+'''
+import argparse
+
+import psycopg2
+
+from common import database_url, format_stats, load_handler, make_event, time_calls
+
+QUERIES = ['alex', 'mar', '@user_12', 'ivanov', 'zzzz', '@a']
+SYLLABLES = "ARRAY['al','ex','ma','ri','iv','an','ov','ka','te','ni','ol','ga','dm','it','ry']"
+
+
+def seed(conn, count: int) -> None:
+    cur = conn.cursor()
+    cur.execute(f"""
+        INSERT INTO users (phone, nickname, username)
+        SELECT 'b' || lpad(n::text, 12, '0'),
+               initcap(s[1 + n % 15] || s[1 + (n / 15) % 15] || s[1 + (n / 225) % 15]) || ' ' || n,
+               'user_' || n
+        FROM generate_series(1, %s) n, (SELECT {SYLLABLES} AS s) syl
+        ON CONFLICT DO NOTHING
+    """, (count,))
+    cur.execute('ANALYZE users')
+    conn.commit()
+    cur.close()
+
+
+def legacy_search(conn, search: str) -> None:
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT id, nickname, username FROM users WHERE username ILIKE %s OR nickname ILIKE %s LIMIT 20",
+        (f'%{search}%', f'%{search}%')
+    )
+    cur.fetchall()
+    cur.close()
+    conn.rollback()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--cleanup', action='store_true')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(database_url())
+    if args.seed:
+        seed(conn, args.seed)
+    users = load_handler('users')
+    try:
+        for search in QUERIES:
+            event = make_event('GET', query={'search': search})
+            print(format_stats(f'indexed  {search!r}', time_calls(lambda: users.handler(event, None), args.iterations)))
+            print(format_stats(f'ILIKE    {search!r}', time_calls(lambda: legacy_search(conn, search.lstrip('@')), args.iterations)))
+    finally:
+        if args.cleanup:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM users WHERE phone LIKE 'b%'")
+            conn.commit()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
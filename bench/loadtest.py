@@ -0,0 +1,284 @@
+'''
+Load test for the backend handlers, run in-process against a local Postgres.
+
+Usage:
+    DATABASE_URL=postgresql://... python bench/loadtest.py --seed --users 10000 \
+        --concurrency 16 --requests 20000 --out results.json [--compare previous.json]
+
+Every handler is imported straight from backend/<name>/index.py. Two kinds of
+traffic are replayed on a thread pool:
+- the scenarios from each function's tests.json;
+- a weighted "realistic" mix of reads and writes over the seeded data.
+
+For every handler:action label the run reports p50/p95/p99 latency,
+throughput and DB queries per request. Queries are counted with a counting
+cursor_factory set on pooled connections. Results are written as JSON, and
+--compare exits non-zero when a label's p95 or queries/request regressed by
+more than --tolerance.
+
+--seed TRUNCATES the messenger tables and fills them with a synthetic data
+set sized by --users/--chats/--chat-size/--messages-per-chat/--friends.
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple
+
+import psycopg2
+import psycopg2.extensions
+
+from common import BACKEND_DIR, database_url, load_handler, make_event, percentile, runtime_of
+
+HANDLERS = ['auth', 'chats', 'friends', 'users']
+CHAT_MEMBER_STRIDE = 7
+
+_query_counter = threading.local()
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        _query_counter.count = getattr(_query_counter, 'count', 0) + 1
+        return super().execute(query, vars)
+
+
+def instrument(module: Any) -> Any:
+    '''Makes every connection the handler's pool hands out create counting cursors.'''
+    runtime = runtime_of(module)
+    acquire = runtime.acquire_connection
+
+    def counting_acquire(db_url: str) -> Any:
+        conn = acquire(db_url)
+        conn.cursor_factory = CountingCursor
+        return conn
+
+    runtime.acquire_connection = counting_acquire
+    return module
+
+
+def seed(conn, args) -> None:
+    cur = conn.cursor()
+    cur.execute("TRUNCATE users, friendships, chats, chat_members, messages, sms_codes, user_updates RESTART IDENTITY")
+    cur.execute("""
+        INSERT INTO users (phone, nickname, username)
+        SELECT 'lt' || n, 'Load User ' || n, 'load_' || n FROM generate_series(1, %s) n
+    """, (args.users,))
+    cur.execute("""
+        INSERT INTO friendships (user_id, friend_id, status)
+        SELECT a, b, 'accepted' FROM (
+            SELECT n AS a, (n + k - 1) %% %(u)s + 1 AS b
+            FROM generate_series(1, %(u)s) n, generate_series(1, %(f)s) k
+        ) e
+        UNION
+        SELECT b, a, 'accepted' FROM (
+            SELECT n AS a, (n + k - 1) %% %(u)s + 1 AS b
+            FROM generate_series(1, %(u)s) n, generate_series(1, %(f)s) k
+        ) e
+    """, {'u': args.users, 'f': args.friends})
+    cur.execute("""
+        INSERT INTO chats (type, name, created_by, member_count)
+        SELECT 'group', 'Load chat ' || c, (c * %(stride)s) %% %(u)s + 1, %(size)s
+        FROM generate_series(1, %(c)s) c
+    """, {'c': args.chats, 'u': args.users, 'size': args.chat_size, 'stride': CHAT_MEMBER_STRIDE})
+    cur.execute("""
+        INSERT INTO chat_members (chat_id, user_id)
+        SELECT c, (c * %(stride)s + j) %% %(u)s + 1
+        FROM generate_series(1, %(c)s) c, generate_series(0, %(size)s - 1) j
+        ON CONFLICT DO NOTHING
+    """, {'c': args.chats, 'u': args.users, 'size': args.chat_size, 'stride': CHAT_MEMBER_STRIDE})
+    cur.execute("SELECT create_message_partitions(LOCALTIMESTAMP - %s * INTERVAL '1 minute', LOCALTIMESTAMP)",
+                (args.messages_per_chat,))
+    cur.execute("""
+        INSERT INTO messages (chat_id, user_id, text, created_at)
+        SELECT c, (c * %(stride)s + n %% %(size)s) %% %(u)s + 1,
+               'Load message ' || n || ' in chat ' || c,
+               NOW() - (%(m)s - n) * INTERVAL '1 minute'
+        FROM generate_series(1, %(c)s) c, generate_series(1, %(m)s) n
+    """, {'c': args.chats, 'u': args.users, 'size': args.chat_size, 'm': args.messages_per_chat,
+          'stride': CHAT_MEMBER_STRIDE})
+    cur.execute("""
+        UPDATE chats c
+        SET last_message_id = lm.id, last_message_preview = LEFT(lm.text, 200),
+            last_message_at = lm.created_at, updated_at = lm.created_at
+        FROM (SELECT chat_id, MAX(id) AS id FROM messages GROUP BY chat_id) mx
+        JOIN messages lm ON lm.id = mx.id
+        WHERE c.id = mx.chat_id
+    """)
+    cur.execute("ANALYZE")
+    conn.commit()
+    cur.close()
+
+
+def tests_json_scenarios() -> List[Tuple[str, str, Dict[str, Any], int]]:
+    '''(handler, label, event, expected status) for every entry of every tests.json.'''
+    scenarios = []
+    for name in HANDLERS:
+        with open(os.path.join(BACKEND_DIR, name, 'tests.json')) as f:
+            tests = json.load(f)['tests']
+        for test in tests:
+            event = make_event(test['method'], body=test.get('body'), query=test.get('query'),
+                               headers=test.get('headers'))
+            label = (test.get('body') or {}).get('action') or test['name']
+            scenarios.append((name, f'{name}:{label}', event, test.get('expectedStatus', 200)))
+    return scenarios
+
+
+def realistic_mix(args) -> List[Tuple[float, Callable[[random.Random], Tuple[str, str, Dict[str, Any]]]]]:
+    '''Weighted request generators over the seeded data set.'''
+    def member_of(rng: random.Random) -> Tuple[int, str]:
+        chat_id = rng.randint(1, args.chats)
+        user_id = (chat_id * CHAT_MEMBER_STRIDE + rng.randrange(args.chat_size)) % args.users + 1
+        return chat_id, str(user_id)
+
+    def chat_list(rng):
+        chat_id, user_id = member_of(rng)
+        return 'chats', 'chats:list', make_event('GET', headers={'X-User-Id': user_id})
+
+    def history(rng):
+        chat_id, user_id = member_of(rng)
+        return 'chats', 'chats:history', make_event('GET', headers={'X-User-Id': user_id},
+                                                    query={'chat_id': str(chat_id)})
+
+    def sync(rng):
+        chat_id, user_id = member_of(rng)
+        return 'chats', 'chats:sync', make_event('GET', headers={'X-User-Id': user_id},
+                                                 query={'chat_id': str(chat_id), 'since_id': '0'})
+
+    def send(rng):
+        chat_id, user_id = member_of(rng)
+        return 'chats', 'chats:send_message', make_event('POST', headers={'X-User-Id': user_id}, body={
+            'action': 'send_message', 'chat_id': chat_id, 'text': f'load {rng.random()}'})
+
+    def difference(rng):
+        chat_id, user_id = member_of(rng)
+        return 'chats', 'chats:difference', make_event('GET', headers={'X-User-Id': user_id},
+                                                       query={'pts': str(rng.randint(0, 50))})
+
+    def search(rng):
+        return 'users', 'users:search', make_event('GET', query={'search': f'load_{rng.randint(1, args.users)}'[:7]})
+
+    def friends(rng):
+        return 'friends', 'friends:list', make_event('GET', headers={'X-User-Id': str(rng.randint(1, args.users))})
+
+    def suggestions(rng):
+        return 'friends', 'friends:suggestions', make_event(
+            'GET', headers={'X-User-Id': str(rng.randint(1, args.users))}, query={'suggestions': '1'})
+
+    return [(30, chat_list), (25, history), (10, sync), (5, difference), (15, send), (10, search), (5, friends),
+            (5, suggestions)]
+
+
+def run(modules: Dict[str, Any], jobs: List[Tuple[str, str, Dict[str, Any], int]], concurrency: int):
+    samples: Dict[str, List[Tuple[float, int, bool]]] = {}
+    lock = threading.Lock()
+
+    def execute(job):
+        name, label, event, expected = job
+        _query_counter.count = 0
+        started = time.perf_counter()
+        try:
+            status = modules[name].handler(event, None)['statusCode']
+            ok = status == expected if expected else status < 500
+        except Exception:
+            ok = False
+        elapsed = (time.perf_counter() - started) * 1000.0
+        with lock:
+            samples.setdefault(label, []).append((elapsed, _query_counter.count, ok))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(execute, jobs))
+    return samples, time.perf_counter() - started
+
+
+def summarize(samples, wall_seconds: float) -> Dict[str, Dict[str, float]]:
+    summary = {}
+    for label, rows in sorted(samples.items()):
+        latencies = [r[0] for r in rows]
+        summary[label] = {
+            'requests': len(rows),
+            'errors': sum(1 for r in rows if not r[2]),
+            'p50_ms': percentile(latencies, 50),
+            'p95_ms': percentile(latencies, 95),
+            'p99_ms': percentile(latencies, 99),
+            'throughput_rps': len(rows) / wall_seconds,
+            'queries_per_request': sum(r[1] for r in rows) / len(rows),
+        }
+    return summary
+
+
+def compare(current: Dict[str, Dict[str, float]], previous: Dict[str, Dict[str, float]], tolerance: float) -> List[str]:
+    regressions = []
+    for label, stats in current.items():
+        before = previous.get(label)
+        if not before:
+            continue
+        for metric in ('p95_ms', 'queries_per_request'):
+            if before[metric] and stats[metric] > before[metric] * (1 + tolerance):
+                regressions.append(f'{label} {metric}: {before[metric]:.3f} -> {stats[metric]:.3f}')
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seed', action='store_true', help='truncate and reseed the database first')
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--chats', type=int, default=2_000)
+    parser.add_argument('--chat-size', type=int, default=20)
+    parser.add_argument('--messages-per-chat', type=int, default=200)
+    parser.add_argument('--friends', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=10_000)
+    parser.add_argument('--tests-json-rounds', type=int, default=20)
+    parser.add_argument('--random-seed', type=int, default=1)
+    parser.add_argument('--out', default='loadtest_results.json')
+    parser.add_argument('--compare')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.seed:
+        conn = psycopg2.connect(database_url())
+        seed(conn, args)
+        conn.close()
+
+    env = {'DB_POOL_SIZE': str(args.concurrency)}
+    modules = {name: instrument(load_handler(name, env)) for name in HANDLERS}
+
+    # tests.json write scenarios (create user, send code) are not idempotent, so status is not checked
+    jobs = [(name, label, event, None) for name, label, event, _ in tests_json_scenarios()] * args.tests_json_rounds
+    rng = random.Random(args.random_seed)
+    mix = realistic_mix(args)
+    weights = [w for w, _ in mix]
+    for generator in rng.choices([g for _, g in mix], weights=weights, k=args.requests):
+        name, label, event = generator(rng)
+        jobs.append((name, label, event, None))
+    rng.shuffle(jobs)
+
+    samples, wall = run(modules, jobs, args.concurrency)
+    summary = summarize(samples, wall)
+    total = sum(s['requests'] for s in summary.values())
+
+    print(f'{"label":<28} {"n":>6} {"err":>5} {"p50":>8} {"p95":>8} {"p99":>8} {"rps":>8} {"q/req":>6}')
+    for label, s in summary.items():
+        print(f'{label:<28} {s["requests"]:>6} {s["errors"]:>5} {s["p50_ms"]:>8.2f} {s["p95_ms"]:>8.2f} '
+              f'{s["p99_ms"]:>8.2f} {s["throughput_rps"]:>8.1f} {s["queries_per_request"]:>6.2f}')
+    print(f'total {total} requests in {wall:.2f}s = {total / wall:.1f} req/s at concurrency {args.concurrency}')
+
+    with open(args.out, 'w') as f:
+        json.dump({'config': vars(args), 'wall_seconds': wall, 'results': summary}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(summary, json.load(f)['results'], args.tolerance)
+        for line in regressions:
+            print(f'REGRESSION {line}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+-- Keyset pagination of chat history: WHERE chat_id = ? AND id < ? ORDER BY id DESC
+CREATE INDEX IF NOT EXISTS idx_messages_chat_id_id ON messages(chat_id, id);
+
+-- Superseded by the composite index above (chat_id is its leading column)
+DROP INDEX IF EXISTS idx_messages_chat;
@@ -0,0 +1,34 @@
+-- Denormalized chat list: member count and last message live on the chat row,
+-- read position lives on the membership row.
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS member_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_message_id INTEGER;
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_message_preview VARCHAR(200);
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_message_at TIMESTAMP;
+
+ALTER TABLE chat_members ADD COLUMN IF NOT EXISTS last_read_message_id INTEGER NOT NULL DEFAULT 0;
+
+UPDATE chats c
+SET member_count = mc.cnt
+FROM (SELECT chat_id, COUNT(*) AS cnt FROM chat_members GROUP BY chat_id) mc
+WHERE mc.chat_id = c.id;
+
+UPDATE chats c
+SET last_message_id = lm.id,
+    last_message_preview = LEFT(lm.text, 200),
+    last_message_at = lm.created_at,
+    updated_at = GREATEST(c.updated_at, lm.created_at)
+FROM (
+  SELECT DISTINCT ON (chat_id) chat_id, id, text, created_at
+  FROM messages
+  ORDER BY chat_id, id DESC
+) lm
+WHERE lm.chat_id = c.id;
+
+UPDATE chat_members cm
+SET last_read_message_id = c.last_message_id
+FROM chats c
+WHERE c.id = cm.chat_id AND c.last_message_id IS NOT NULL;
+
+-- Chat list: WHERE user_id = ? served from the index, read position included
+CREATE INDEX IF NOT EXISTS idx_chat_members_user_chat ON chat_members(user_id, chat_id) INCLUDE (last_read_message_id);
+DROP INDEX IF EXISTS idx_chat_members_user;
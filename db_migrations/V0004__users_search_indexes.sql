@@ -0,0 +1,8 @@
+-- Substring search: lower(username|nickname) LIKE '%q%' via trigram GIN indexes
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS idx_users_username_trgm ON users USING GIN (lower(username) gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_users_nickname_trgm ON users USING GIN (lower(nickname) gin_trgm_ops);
+
+-- '@username' prefix lookups and their keyset order
+CREATE INDEX IF NOT EXISTS idx_users_username_prefix ON users ((lower(username) COLLATE "C"), id);
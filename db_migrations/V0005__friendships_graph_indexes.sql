@@ -0,0 +1,4 @@
+-- Adjacency lookups for friend lists, mutual friends and suggestions:
+-- index-only scans of accepted edges in both directions
+CREATE INDEX IF NOT EXISTS idx_friendships_user_accepted ON friendships(user_id, friend_id) WHERE status = 'accepted';
+CREATE INDEX IF NOT EXISTS idx_friendships_friend_accepted ON friendships(friend_id, user_id) WHERE status = 'accepted';
@@ -0,0 +1,13 @@
+-- Token buckets for SMS code requests (per phone and per client IP)
+CREATE TABLE IF NOT EXISTS rate_limits (
+  bucket VARCHAR(100) PRIMARY KEY,
+  capacity REAL NOT NULL,
+  refill_per_sec REAL NOT NULL,
+  tokens REAL NOT NULL,
+  allowed BOOLEAN NOT NULL DEFAULT TRUE,
+  updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- verify_code only ever looks at pending codes; verified rows are swept
+CREATE INDEX IF NOT EXISTS idx_sms_codes_pending ON sms_codes(phone, code, expires_at DESC) WHERE verified = FALSE;
+DROP INDEX IF EXISTS idx_sms_codes_phone;
@@ -0,0 +1,65 @@
+-- Messages become range-partitioned by month on created_at, so each month's
+-- heap and indexes stay bounded and old months can be detached and archived.
+-- The primary key has to include the partition key; ids still come from the
+-- same sequence and stay unique.
+ALTER TABLE messages RENAME TO messages_unpartitioned;
+ALTER TABLE messages_unpartitioned RENAME CONSTRAINT messages_pkey TO messages_unpartitioned_pkey;
+ALTER SEQUENCE messages_id_seq OWNED BY NONE;
+
+CREATE TABLE messages (
+  id INTEGER NOT NULL DEFAULT nextval('messages_id_seq'),
+  chat_id INTEGER NOT NULL,
+  user_id INTEGER,
+  text TEXT NOT NULL,
+  created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+ALTER SEQUENCE messages_id_seq OWNED BY messages.id;
+
+-- Creates the missing monthly partitions (messages_YYYY_MM) covering
+-- [from_ts, to_ts]. Called by the chats function ahead of time and by the
+-- archival job; safe to run concurrently.
+CREATE OR REPLACE FUNCTION create_message_partitions(from_ts TIMESTAMP, to_ts TIMESTAMP)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  month_start TIMESTAMP := date_trunc('month', from_ts);
+  partition_name TEXT;
+  created INTEGER := 0;
+BEGIN
+  PERFORM pg_advisory_xact_lock(hashtext('create_message_partitions'));
+  WHILE month_start <= to_ts LOOP
+    partition_name := 'messages_' || to_char(month_start, 'YYYY_MM');
+    IF to_regclass(partition_name) IS NULL THEN
+      EXECUTE format(
+        'CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+        partition_name, month_start, month_start + INTERVAL '1 month'
+      );
+      created := created + 1;
+    END IF;
+    month_start := month_start + INTERVAL '1 month';
+  END LOOP;
+  RETURN created;
+END
+$$;
+
+SELECT create_message_partitions(
+  COALESCE((SELECT MIN(created_at) FROM messages_unpartitioned), LOCALTIMESTAMP),
+  LOCALTIMESTAMP + INTERVAL '3 months'
+);
+
+INSERT INTO messages (id, chat_id, user_id, text, created_at)
+SELECT id, chat_id, user_id, text, COALESCE(created_at, LOCALTIMESTAMP)
+FROM messages_unpartitioned;
+
+DROP TABLE messages_unpartitioned;
+
+-- Per-partition indexes: id-keyed reads (sync, unread counts) and history,
+-- which pages by (created_at, id) so the cursor prunes partitions.
+-- idx_messages_created is gone: the partition bounds already order by time.
+CREATE INDEX IF NOT EXISTS idx_messages_chat_id_id ON messages(chat_id, id);
+CREATE INDEX IF NOT EXISTS idx_messages_chat_created_id ON messages(chat_id, created_at, id);
+
+ANALYZE messages;
@@ -0,0 +1,9 @@
+-- Full-text search over message text (chats GET ?search=). The 'russian'
+-- configuration stems Russian words and hands Latin ones to the English
+-- stemmer; SEARCH_CONFIG in backend/chats must name the same configuration.
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector
+  GENERATED ALWAYS AS (to_tsvector('russian', text)) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_messages_search ON messages USING GIN (search_vector);
+
+ANALYZE messages;
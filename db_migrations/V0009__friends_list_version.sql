@@ -0,0 +1,3 @@
+-- Bumped for both users whenever a friendship is accepted; the friends
+-- function derives the friends list ETag from it.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS friends_version INTEGER NOT NULL DEFAULT 0;
@@ -0,0 +1,21 @@
+-- Per-user update sequence for multi-device sync. Every change a user should
+-- see (new message, new chat, friendship change) appends one row under the
+-- user's next pts, and get_difference replays the rows after a device's last
+-- seen pts in one indexed range scan. users.pts is the last pts handed out;
+-- a user's pts are gapless and committed in order.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS pts INTEGER NOT NULL DEFAULT 0;
+
+CREATE TABLE IF NOT EXISTS user_updates (
+  user_id INTEGER NOT NULL,
+  pts INTEGER NOT NULL,
+  kind VARCHAR(20) NOT NULL,
+  chat_id INTEGER,
+  message_id INTEGER,
+  message_at TIMESTAMP,
+  peer_id INTEGER,
+  created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (user_id, pts)
+);
+
+-- Retention sweep of old updates
+CREATE INDEX IF NOT EXISTS idx_user_updates_created ON user_updates(created_at);
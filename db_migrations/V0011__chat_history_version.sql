@@ -0,0 +1,5 @@
+-- Bumped whenever messages appear in or vanish from the middle of a chat's
+-- history (bulk imports, archiving and restoring a month); the chats
+-- function includes it in the history page ETags, which sends alone
+-- don't invalidate.
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS history_version INTEGER NOT NULL DEFAULT 0;
@@ -0,0 +1,22 @@
+-- Phones are stored in canonical form (backend/_runtime.py normalize_phone):
+-- digits only, a domestic leading 8 written as 7. Rewrites existing users;
+-- where several rows share a canonical number only the oldest is rewritten,
+-- the others keep their old value for manual review. Pending codes are
+-- short-lived and simply dropped.
+WITH canonical AS (
+  SELECT DISTINCT ON (phone) id, phone
+  FROM (
+    SELECT id,
+           CASE WHEN length(d) = 11 AND left(d, 1) = '8' THEN '7' || substr(d, 2) ELSE d END AS phone
+    FROM (SELECT id, regexp_replace(phone, '[^0-9]', '', 'g') AS d FROM users) digits
+  ) normalized
+  ORDER BY phone, id
+)
+UPDATE users u
+SET phone = canonical.phone
+FROM canonical
+WHERE u.id = canonical.id
+  AND u.phone <> canonical.phone
+  AND NOT EXISTS (SELECT 1 FROM users other WHERE other.phone = canonical.phone);
+
+DELETE FROM sms_codes WHERE phone ~ '[^0-9]';
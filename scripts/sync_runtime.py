@@ -0,0 +1,65 @@
+'''
+Copies the shared runtime into every function directory, or checks the copies.
+
+Usage:
+    python scripts/sync_runtime.py           # after editing backend/_runtime.py
+    python scripts/sync_runtime.py --check   # exits 1 while any copy differs
+
+Each function in backend/func2url.json is deployed from its own directory,
+so it gets backend/<name>/_runtime.py: backend/_runtime.py behind a one-line
+"generated" marker. Copies are only ever written by this script; --check
+(for CI or a pre-commit hook) lists every copy that is missing or has been
+edited by hand.
+'''
+import argparse
+import json
+import os
+import sys
+from typing import Dict, List
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend')
+SOURCE = os.path.join(BACKEND_DIR, '_runtime.py')
+MARKER = '# Generated from backend/_runtime.py by scripts/sync_runtime.py: edit that file, not this copy.\n'
+
+
+def copy_paths() -> Dict[str, str]:
+    with open(os.path.join(BACKEND_DIR, 'func2url.json')) as f:
+        names = sorted(json.load(f))
+    return {name: os.path.join(BACKEND_DIR, name, '_runtime.py') for name in names}
+
+
+def stale_copies(expected: str) -> List[str]:
+    stale = []
+    for name, path in copy_paths().items():
+        try:
+            with open(path) as f:
+                if f.read() == expected:
+                    continue
+        except FileNotFoundError:
+            pass
+        stale.append(name)
+    return stale
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--check', action='store_true', help='only report copies that differ')
+    args = parser.parse_args()
+
+    with open(SOURCE) as f:
+        expected = MARKER + f.read()
+    stale = stale_copies(expected)
+    if args.check:
+        if stale:
+            print(f'runtime copies out of date: {", ".join(stale)}; run scripts/sync_runtime.py', file=sys.stderr)
+            sys.exit(1)
+        return
+    paths = copy_paths()
+    for name in stale:
+        with open(paths[name], 'w') as f:
+            f.write(expected)
+        print(f'updated backend/{name}/_runtime.py')
+
+
+if __name__ == '__main__':
+    main()
@@ -5,7 +5,7 @@ import Icon from '@/components/ui/icon';
 
 interface CodeVerificationProps {
   phone: string;
-  onVerify: (userExists: boolean, userData?: any) => void;
+  onVerify: (userExists: boolean, userData?: any, registrationTicket?: string | null) => void;
   onBack: () => void;
 }
 
@@ -84,7 +84,7 @@ export default function CodeVerification({ phone, onVerify, onBack }: CodeVerifi
       const data = await response.json();
 
       if (response.ok && data.success) {
-        onVerify(data.user_exists, data.user);
+        onVerify(data.user_exists, data.user && { ...data.user, token: data.token }, data.registration_ticket);
       } else {
         setError(data.error || 'Неверный код');
         setCode(['', '', '', '', '', '']);
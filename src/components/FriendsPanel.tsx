@@ -28,10 +28,15 @@ export default function FriendsPanel({ userId, onStartChat }: FriendsPanelProps)
     loadFriends();
   }, [userId]);
 
+  const authHeaders = (): Record<string, string> => {
+    const token = localStorage.getItem('sessionToken');
+    return token ? { Authorization: `Bearer ${token}` } : { 'X-User-Id': userId };
+  };
+
   const loadFriends = async () => {
     try {
       const response = await fetch('https://functions.poehali.dev/846e9d6a-42a5-4034-8189-90d589c02a96', {
-        headers: { 'X-User-Id': userId }
+        headers: authHeaders()
       });
       const data = await response.json();
       setFriends(data);
@@ -62,7 +67,7 @@ export default function FriendsPanel({ userId, onStartChat }: FriendsPanelProps)
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
-          'X-User-Id': userId
+          ...authHeaders()
         },
         body: JSON.stringify({ action: 'send_request', friend_id: friendId })
       });
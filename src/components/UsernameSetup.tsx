@@ -6,10 +6,11 @@ import Icon from '@/components/ui/icon';
 
 interface UsernameSetupProps {
   phone: string;
+  registrationTicket?: string | null;
   onComplete: (nickname: string, username: string) => void;
 }
 
-export default function UsernameSetup({ phone, onComplete }: UsernameSetupProps) {
+export default function UsernameSetup({ phone, registrationTicket, onComplete }: UsernameSetupProps) {
   const [nickname, setNickname] = useState('');
   const [username, setUsername] = useState('');
   const [error, setError] = useState('');
@@ -39,7 +40,7 @@ export default function UsernameSetup({ phone, onComplete }: UsernameSetupProps)
       const response = await fetch('https://functions.poehali.dev/60a67547-2730-4d4f-9251-9409c3b811e6', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ phone, nickname, username })
+        body: JSON.stringify({ phone, nickname, username, registration_ticket: registrationTicket })
       });
 
       const data = await response.json();
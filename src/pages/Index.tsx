@@ -13,6 +13,7 @@ type AuthStep = 'phone' | 'code' | 'setup' | 'authorized';
 export default function Index() {
   const [authStep, setAuthStep] = useState<AuthStep>('phone');
   const [phoneNumber, setPhoneNumber] = useState('');
+  const [registrationTicket, setRegistrationTicket] = useState<string | null>(null);
   const [currentUser, setCurrentUser] = useState<any>(null);
   const [selectedFriend, setSelectedFriend] = useState<{ id: number; name: string } | null>(null);
 
@@ -32,14 +33,16 @@ export default function Index() {
     setAuthStep('code');
   };
 
-  const handleCodeVerify = (userExists: boolean, userData?: any) => {
+  const handleCodeVerify = (userExists: boolean, userData?: any, ticket?: string | null) => {
     if (userExists) {
       setCurrentUser(userData);
       localStorage.setItem('userId', userData.id);
       localStorage.setItem('userNickname', userData.nickname);
       localStorage.setItem('userUsername', userData.username);
+      if (userData.token) localStorage.setItem('sessionToken', userData.token);
       setAuthStep('authorized');
     } else {
+      setRegistrationTicket(ticket ?? null);
       setAuthStep('setup');
     }
   };
@@ -49,7 +52,7 @@ export default function Index() {
       const response = await fetch('https://functions.poehali.dev/60a67547-2730-4d4f-9251-9409c3b811e6', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ phone: phoneNumber, nickname, username })
+        body: JSON.stringify({ phone: phoneNumber, nickname, username, registration_ticket: registrationTicket })
       });
       const data = await response.json();
       
@@ -58,6 +61,7 @@ export default function Index() {
         localStorage.setItem('userId', data.id);
         localStorage.setItem('userNickname', nickname);
         localStorage.setItem('userUsername', username);
+        if (data.token) localStorage.setItem('sessionToken', data.token);
         setAuthStep('authorized');
       }
     } catch (err) {
@@ -105,6 +109,7 @@ export default function Index() {
       <div className="h-screen flex items-center justify-center bg-secondary/30">
         <UsernameSetup
           phone={phoneNumber}
+          registrationTicket={registrationTicket}
           onComplete={handleUsernameSetup}
         />
       </div>